@@ -4,15 +4,16 @@ from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_bcrypt import Bcrypt
+from app.routing import RoutingSession
 
 
 app = Flask(__name__)
 app.config.from_object(Config)
 cors = CORS(app)
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 migrate = Migrate(app, db)
 bcrypt = Bcrypt(app)
 
-from app import routes, models, errors, api, auth, util
+from app import routes, models, errors, api, auth, util, search, tag_index, principals, activity, batch, commands, metrics, related, feed, tag_bitmaps, ratelimit
 app.register_blueprint(api.api_bp, url_prefix='/api', name='api')
 app.register_blueprint(auth.auth_bp, url_prefix='/auth', name='auth')
@@ -0,0 +1,69 @@
+from sqlalchemy import case, update
+
+from app import app, db
+from app.models import User
+from app.util import get_now
+
+import atexit
+import threading
+
+
+class LastSeenBuffer(object):
+    """
+    Write-behind buffer for User.last_seen.
+
+    Requests record activity in memory; at most one update per user is kept every
+    LAST_SEEN_GRANULARITY seconds, and a background thread writes pending values every
+    LAST_SEEN_FLUSH_INTERVAL seconds in a single UPDATE. Whatever is still pending is
+    written when the worker exits.
+    """
+
+    # Users per UPDATE statement
+    chunk_size = 500
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.recorded = {}
+        self.flusher = None
+
+    def touch(self, user_id):
+        now = get_now()
+        with self.lock:
+            if now - self.recorded.get(user_id, 0) < app.config['LAST_SEEN_GRANULARITY']:
+                return
+            self.recorded[user_id] = now
+            self.pending[user_id] = now
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.run, name='last-seen-flusher', daemon=True)
+                self.flusher.start()
+
+    def run(self):
+        stop = threading.Event()
+        while not stop.wait(app.config['LAST_SEEN_FLUSH_INTERVAL']):
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.exception('Could not flush last_seen updates: %s', e)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            # Forget users we won't coalesce with any more, so this doesn't grow forever
+            cutoff = get_now() - app.config['LAST_SEEN_GRANULARITY']
+            self.recorded = {user_id: ts for user_id, ts in self.recorded.items() if ts > cutoff}
+        if not pending:
+            return
+        items = list(pending.items())
+        with app.app_context(), db.engine.begin() as connection:
+            for start in range(0, len(items), self.chunk_size):
+                chunk = dict(items[start:start + self.chunk_size])
+                connection.execute(
+                    update(User)
+                    .where(User.id.in_(chunk))
+                    .values(last_seen=case(chunk, value=User.id))
+                )
+
+
+last_seen_buffer = LastSeenBuffer()
+atexit.register(last_seen_buffer.flush)
@@ -1,14 +1,56 @@
 from flask import Blueprint, request, abort, g
+from sqlalchemy.orm import joinedload, selectinload
 
 from app import app, db
-from app.models import User, Project, Review
-from app.util import to_json, succ, fail, get_now
+from app.models import User, Project, Review, CollectionVersion
+from app.util import (to_json, to_json_stream, paginate, page_limit, conditional, encode_cursor, decode_cursor, succ, fail,
+                      get_now, requested_fields, serializable_fields, field_options)
+from app.search import search_project_ids
+from app.tag_index import tag_index
+from app.tag_bitmaps import tag_bitmaps
+from app.related import related_project_ids
+from app.feed import feed_project_ids
+from app.principals import authenticate, principal_cache
+from app.activity import last_seen_buffer
+from app.batch import read_ndjson, chunks, apply_chunk
+from app.cache import TTLCache
+from app.metrics import cache_lookup
+from app.routing import route_request, record_write
+from app.timing import timed
 
 import datetime
+import uuid
 
 
 api_bp = Blueprint('api', __name__)
 
+# Ids of the top trending projects, by limit
+trending_cache = TTLCache(16, app.config['TRENDING_CACHE_TTL'], cache_lookup('trending'))
+
+# Relationships serialized with every project, by field, loaded up front so that a
+# listing costs a fixed number of queries however many projects it holds
+PROJECT_LOADERS = {'user': joinedload(Project.user), 'tags': selectinload(Project.tags)}
+
+
+def project_loads(fields):
+    """
+    :return: loader options for serializing these fields of projects (see requested_fields)
+    """
+    return field_options(Project, fields, PROJECT_LOADERS, Project.created_at)
+
+
+def fields_error(model):
+    return fail('Fields must be among: %s.' % ', '.join(serializable_fields(model)))
+
+
+def load_projects(project_ids, fields=serializable_fields(Project)):
+    """
+    :return: the projects with these ids, in the same order (missing ones are skipped)
+    """
+    projects = {project.id: project for project in
+                Project.query.options(*project_loads(fields)).filter(Project.id.in_(project_ids))}
+    return [projects[project_id] for project_id in project_ids if project_id in projects]
+
 
 @api_bp.errorhandler(404)
 def not_found(error):
@@ -38,87 +80,275 @@ def setup_request():
         token = request.headers.get('Authorization')
         if token is not None:
             token = token.split(' ')[-1]
-            g.user = User.from_token(token)
+            with timed('auth'):
+                g.user = authenticate(token)
             if g.user is not None:
-                g.user.last_seen = get_now()
-                db.session.commit()
+                last_seen_buffer.touch(g.user.id)
+                route_request(app, request.method, g.user.id)
         if not g.user:
             return fail('You must be authenticated to use this endpoint.', 401)
         try:
             g.json = request.get_json()
         except Exception as e:
             g.json = None
-        print('User: ' + (g.user.email if g.user else 'anonymous'))
+
+
+@api_bp.after_request
+def finish_request(response):
+    if g.get('user') is not None:
+        record_write(app, request.method, g.user.id)
+    return response
+
+
+@api_bp.route('/stats')
+def api_stats():
+    if not g.user.admin:
+        abort(403)
+    return to_json({
+        'principal_cache': principal_cache.stats(),
+        'trending_cache': trending_cache.stats(),
+    })
 
 
 @api_bp.route('/users')
 def api_users():
-    users = User.query.all()
-    return to_json(users)
+    fields = requested_fields(User)
+    if fields is None:
+        return fields_error(User)
+    users = User.query.options(*field_options(User, fields, {}, User.registered_at))
+    return conditional('users.%d' % CollectionVersion.get('users'),
+                       lambda: paginate(users, User.registered_at, User.id, only=(User, fields)))
+
+
+@api_bp.route('/users/export')
+def api_users_export():
+    fields = requested_fields(User)
+    if fields is None:
+        return fields_error(User)
+    users = User.query.options(*field_options(User, fields, {}, User.registered_at))
+    return to_json_stream(users.order_by(User.registered_at, User.id), only=(User, fields))
 
 
 @api_bp.route('/users/<user_id>')
 def api_user(user_id):
-    user = User.query.get_or_404(user_id)
-    return to_json(user)
+    fields = requested_fields(User)
+    if fields is None:
+        return fields_error(User)
+    version = db.session.query(User.version).filter_by(id=user_id).scalar()
+    if version is None:
+        abort(404)
+    user = User.query.options(*field_options(User, fields, {}))
+    return conditional('user.%s.%d' % (user_id, version),
+                       lambda: to_json(user.get_or_404(user_id), only=(User, fields)))
 
 
 @api_bp.route('/users/<user_id>/projects')
 def api_user_projects(user_id):
-    user = User.query.get_or_404(user_id)
-    return to_json(user.projects)
+    fields = requested_fields(Project)
+    if fields is None:
+        return fields_error(Project)
+    if db.session.query(User.id).filter_by(id=user_id).first() is None:
+        abort(404)
+    projects = Project.query.options(*project_loads(fields)).filter_by(user_id=user_id)
+    return conditional('projects.%d' % CollectionVersion.get('projects'),
+                       lambda: paginate(projects, Project.created_at, Project.id, only=(Project, fields)))
 
 
 @api_bp.route('/users/search/<query>')
 def search_users(query):
+    fields = requested_fields(User)
+    if fields is None:
+        return fields_error(User)
     query = query.lower()
-    users = User.query.filter(User.name.ilike('%' + query + '%')).all()
-    return to_json(users)
+    users = User.query.options(*field_options(User, fields, {})).filter(User.name.ilike('%' + query + '%')).all()
+    return to_json(users, only=(User, fields))
+
+
+def tag_filter():
+    """
+    Tags to filter by, from ?tags=a,b and ?mode=all|any.
+    :return: (tag names, empty if not filtering, mode), or None if the mode is invalid
+    """
+    mode = request.args.get('mode', 'all')
+    if mode not in ('all', 'any'):
+        return None
+    tags = request.args.get('tags', '')
+    return [name.strip().lower() for name in tags.split(',') if name.strip()], mode
+
+
+def paginate_tagged(names, mode, fields):
+    """
+    Like paginate() over all projects, with the same cursors and headers, for the projects
+    matching the tags. Matches and their order come from the tag bitmaps.
+    """
+    limit = page_limit()
+    if limit is None:
+        return fail('Limit must be an integer.')
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        after = decode_cursor(cursor)
+        if (after is None or len(after) != 2 or not isinstance(after[0], (int, type(None)))
+                or not isinstance(after[1], str)):
+            return fail('Invalid cursor.')
+    project_ids, total, next_key = tag_bitmaps.page(names, mode, after, limit)
+    response = to_json(load_projects(project_ids, fields), only=(Project, fields))
+    if next_key is not None:
+        response.headers['X-Next-Cursor'] = encode_cursor(next_key)
+    if request.args.get('count', '').lower() in ('1', 'true'):
+        response.headers['X-Total-Count'] = str(total)
+    return response
 
 
 @api_bp.route('/projects')
 def api_projects():
-    projects = Project.query.all()
-    return to_json(projects)
+    fields = requested_fields(Project)
+    if fields is None:
+        return fields_error(Project)
+    tags = tag_filter()
+    if tags is None:
+        return fail('Mode must be "all" or "any".')
+    names, mode = tags
+    if names:
+        return conditional('projects.%d.tags.%s' % (CollectionVersion.get('projects'), tag_bitmaps.etag()),
+                           lambda: paginate_tagged(names, mode, fields))
+    projects = Project.query.options(*project_loads(fields))
+    return conditional('projects.%d' % CollectionVersion.get('projects'),
+                       lambda: paginate(projects, Project.created_at, Project.id, only=(Project, fields)))
 
 
 @api_bp.route('/projects', methods=['POST'])
 def api_project_create():
-    tags = g.json.pop('tags')
+    tags = g.json.pop('tags', [])
     # TODO: verify security implications
     project = Project(user_id=g.user.id, created_at=get_now(), **g.json)
+    if project.id is None:
+        project.id = str(uuid.uuid4())
     db.session.add(project)
-    for tag_name in tags:
-        project.add_tag(tag_name.lower())
+    project.set_tags(tags)
     db.session.commit()
     return to_json(project)
 
 
+@api_bp.route('/projects/export')
+def api_projects_export():
+    fields = requested_fields(Project)
+    if fields is None:
+        return fields_error(Project)
+    projects = Project.query.options(*project_loads(fields)).order_by(Project.created_at, Project.id)
+    return to_json_stream(projects, only=(Project, fields))
+
+
+@api_bp.route('/projects/trending')
+def api_projects_trending():
+    limit = page_limit()
+    if limit is None:
+        return fail('Limit must be an integer.')
+    fields = requested_fields(Project)
+    if fields is None:
+        return fields_error(Project)
+    # Top projects by the indexed trending_score, shared by all requests for a few seconds
+    project_ids = trending_cache.get(limit)
+    if project_ids is None:
+        project_ids = [row.id for row in db.session.query(Project.id)
+                       .filter(Project.trending_score > 0)
+                       .order_by(Project.trending_score.desc(), Project.id)
+                       .limit(limit)]
+        trending_cache.set(limit, project_ids)
+    return to_json(load_projects(project_ids, fields), only=(Project, fields))
+
+
+@api_bp.route('/projects/batch', methods=['POST'])
+def api_project_batch():
+    # Either a JSON array, or NDJSON (one project per line) which is read as it streams in
+    if request.mimetype == 'application/x-ndjson':
+        items = read_ndjson(request.stream)
+    elif isinstance(g.json, list):
+        items = g.json
+    else:
+        return fail('Expected a JSON array or NDJSON of projects.')
+    results = []
+    for chunk in chunks(items, app.config['BATCH_CHUNK_SIZE']):
+        results += apply_chunk(chunk, g.user, len(results))
+    return to_json(results)
+
+
 @api_bp.route('/projects/<project_id>')
 def api_project(project_id):
-    project = Project.query.get_or_404(project_id)
-    return to_json(project)
+    fields = requested_fields(Project)
+    if fields is None:
+        return fields_error(Project)
+    # The project embeds its user, so both versions go into the ETag
+    versions = db.session.query(Project.version, User.version).join(Project.user).filter(Project.id == project_id).first()
+    if versions is None:
+        abort(404)
+    return conditional('project.%s.%d.%d' % (project_id, versions[0], versions[1]),
+                       lambda: to_json(Project.query.options(*project_loads(fields)).get_or_404(project_id),
+                                       only=(Project, fields)))
 
 
 @api_bp.route('/projects/<project_id>', methods=['PUT'])
 def api_project_update(project_id):
-    tags = g.json.pop('tags')
+    tags = g.json.pop('tags', None)
     project = Project.query.get_or_404(project_id)
     project.update(g.json)
-    project.tags[:] = []
-    for tag_name in tags:
-        project.add_tag(tag_name.lower())
+    if tags is not None:
+        project.set_tags(tags)
     db.session.commit()
     return to_json(project)
 
 
+@api_bp.route('/projects/<project_id>/related')
+def api_project_related(project_id):
+    limit = page_limit()
+    if limit is None:
+        return fail('Limit must be an integer.')
+    fields = requested_fields(Project)
+    if fields is None:
+        return fields_error(Project)
+    if db.session.query(Project.id).filter_by(id=project_id).first() is None:
+        abort(404)
+    # Projects with similar tags, from the in-memory MinHash index; ?weight=likes favours popular ones
+    project_ids = related_project_ids(project_id, limit, request.args.get('weight') == 'likes')
+    return to_json(load_projects(project_ids, fields), only=(Project, fields))
+
+
+@api_bp.route('/feed')
+def api_feed():
+    limit = page_limit()
+    if limit is None:
+        return fail('Limit must be an integer.')
+    fields = requested_fields(Project)
+    if fields is None:
+        return fields_error(Project)
+    return to_json(load_projects(feed_project_ids(g.user.id, limit), fields), only=(Project, fields))
+
+
 @api_bp.route('/projects/search/', defaults={'query': ''})
 @api_bp.route('/projects/search/<query>')
 def search_projects(query):
-    query = query.lower()
-    projects = Project.query.filter(Project.name.ilike('%' + query + '%')).all()
-    print(projects)
-    return to_json(projects)
+    fields = requested_fields(Project)
+    if fields is None:
+        return fields_error(Project)
+    if not query.strip():
+        return paginate(Project.query.options(*project_loads(fields)), Project.created_at, Project.id,
+                        only=(Project, fields))
+    # Results are ranked, so the cursor is the offset into the ranking
+    limit = page_limit()
+    if limit is None:
+        return fail('Limit must be an integer.')
+    offset = 0
+    cursor = request.args.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor)
+        if not values or not isinstance(values[0], int) or isinstance(values[0], bool) or values[0] < 0:
+            return fail('Invalid cursor.')
+        offset = values[0]
+    project_ids = search_project_ids(query, limit + 1, offset)
+    response = to_json(load_projects(project_ids[:limit], fields), only=(Project, fields))
+    if len(project_ids) > limit:
+        response.headers['X-Next-Cursor'] = encode_cursor([offset + limit])
+    return response
 
 
 @api_bp.route('/projects/<project_id>/tags/<tag_name>', methods=['POST'])
@@ -151,11 +381,24 @@ def remove_tag(project_id, tag_name):
     return fail('Tag not removed.')
 
 
+@api_bp.route('/tags')
+def api_tags():
+    limit = page_limit()
+    if limit is None:
+        return fail('Limit must be an integer.')
+    tags = tag_filter()
+    if tags is None:
+        return fail('Mode must be "all" or "any".')
+    # Projects per tag, or with ?tags=, per tag among the projects matching them (facets)
+    names, mode = tags
+    counts = tag_bitmaps.counts(names, mode)
+    return to_json([{'name': name, 'count': count} for name, count in counts[:limit]])
+
+
 @api_bp.route('/tags/search/<query>')
 def search_tags(query):
-    query = query.lower()
-    tags = Tag.query.filter(Tag.name.ilike('%' + query + '%'))
-    return to_json([tag.name for tag in tags])
+    limit = min(request.args.get('limit', app.config['TAG_SEARCH_LIMIT'], type=int), app.config['API_MAX_PAGE_SIZE'])
+    return to_json(tag_index.search(query.lower(), max(1, limit)))
 
 
 # This is a kinda useless endpoint
@@ -169,20 +412,17 @@ def api_project_item_reviews(project_id):
 
 @api_bp.route('/projects/<project_id>/reviews', methods=['POST'])
 def api_project_item_reviews_create(project_id):
-    project = Project.query.get_or_404(project_id)
-    review = Review.query.filter_by(user_id=g.user.id, project_id=project_id).first()
-    if review is None:
-        review = Review(created_at=get_now(), user_id=g.user.id, project_id=project_id)
-        db.session.add(review)
-        db.session.commit()
-    project.update_like_count()
-    return to_json(project.reviews)
+    like_count = Review.like(g.user.id, project_id)
+    if like_count is None:
+        abort(404)
+    db.session.commit()
+    return to_json({'project_id': project_id, 'like_count': like_count, 'liked': True})
 
 
 @api_bp.route('/projects/<project_id>/reviews', methods=['DELETE'])
 def api_project_item_reviews_delete(project_id):
-    review = Review.query.filter_by(user_id=g.user.id, project_id=project_id).first_or_404()
-    db.session.delete(review)
+    like_count = Review.unlike(g.user.id, project_id)
+    if like_count is None:
+        abort(404)
     db.session.commit()
-    project.update_like_count()
-    return succ('Review removed.')
+    return to_json({'project_id': project_id, 'like_count': like_count, 'liked': False})
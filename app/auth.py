@@ -109,6 +109,10 @@ def login():
         if not user.confirmed:
             send_confirmation_email(user)
             return fail('Please check your email to confirm your account before logging in! It may take a few minutes to arrive. We have re-sent the email to you just in case.', 401)
+        if user.needs_rehash():
+            # BCRYPT_LOG_ROUNDS changed since this hash was made; we have the password now
+            user.set_password(payload.get('password'))
+            db.session.commit()
         token = user.generate_token()
         if token:
             response_data = {
@@ -0,0 +1,123 @@
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
+
+from app import app, db
+from app.models import Project, Tag
+from app.util import get_now
+
+import itertools
+import json
+import uuid
+
+
+# Keys a batch item may carry besides the editable project fields
+BATCH_KEYS = {'id', 'tags'}
+# Stands in for an NDJSON line that isn't valid JSON
+INVALID_JSON = object()
+
+
+def validate_item(item):
+    """
+    :return: error message for a batch item, or None if it is valid
+    """
+    if item is INVALID_JSON:
+        return 'Invalid JSON.'
+    if not isinstance(item, dict):
+        return 'Item must be an object.'
+    if not isinstance(item.get('id', ''), str):
+        return 'Project id must be a string.'
+    unknown = item.keys() - Project.__editable__ - BATCH_KEYS
+    if unknown:
+        return 'Unknown fields: ' + ', '.join(sorted(unknown))
+    # Caught here rather than at commit, where one bad value would fail its whole chunk
+    for field in sorted(item.keys() & Project.__editable__):
+        if item[field] is not None and not isinstance(item[field], str):
+            return 'Field %s must be a string or null.' % field
+    if 'name' in item and not (item['name'] or '').strip():
+        return 'Project name must not be empty.'
+    tags = item.get('tags', [])
+    if not isinstance(tags, list) or not all(isinstance(tag, str) and 0 < len(tag.strip()) <= 32 for tag in tags):
+        return 'Tags must be a list of names of up to 32 characters.'
+    return None
+
+
+def read_ndjson(stream):
+    """
+    Yield one item per non-blank line of an NDJSON stream, without reading it all at once.
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield INVALID_JSON
+
+
+def chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def apply_chunk(items, user, offset=0):
+    """
+    Create or update a chunk of projects in one transaction.
+
+    Items with the id of an existing project update it (if user may edit it); any other
+    item creates a project. Existing projects and every tag in the chunk are each loaded
+    with one query, and new projects are inserted together at commit.
+    :param offset: index of the chunk's first item in the whole batch
+    :return: one result dict per item
+    """
+    results = [None] * len(items)
+    valid = {}
+    for i, item in enumerate(items):
+        error = validate_item(item)
+        if error:
+            results[i] = {'index': offset + i, 'status': 'fail', 'message': error}
+        else:
+            valid[i] = item
+
+    ids = [item['id'] for item in valid.values() if 'id' in item]
+    existing = {}
+    if ids:
+        projects = Project.query.options(selectinload(Project.tags)).filter(Project.id.in_(ids))
+        existing = {project.id: project for project in projects}
+    tag_names = {tag.strip().lower() for item in valid.values() for tag in item.get('tags', [])}
+    with db.session.no_autoflush:
+        resolved = {tag.name: tag for tag in Tag.resolve(tag_names)} if tag_names else {}
+
+        now = get_now()
+        for i, item in valid.items():
+            fields = {key: value for key, value in item.items() if key in Project.__editable__}
+            project = existing.get(item.get('id'))
+            if project is not None:
+                if not (user.admin or project.is_hosted_by(user)):
+                    results[i] = {'index': offset + i, 'status': 'fail', 'message': 'You don\'t have permission to edit this project.'}
+                    continue
+                project.update(fields)
+                project.updated_at = now
+            else:
+                if not fields.get('name'):
+                    results[i] = {'index': offset + i, 'status': 'fail', 'message': 'New projects need a name.'}
+                    continue
+                project = Project(id=item.get('id') or str(uuid.uuid4()), user_id=user.id, created_at=now, **fields)
+                db.session.add(project)
+                existing[project.id] = project
+            if 'tags' in item:
+                project.set_tags(item['tags'], resolved)
+            results[i] = {'index': offset + i, 'status': 'success', 'id': project.id}
+
+    try:
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        app.logger.warning('Project batch chunk failed: %s', e)
+        for i in valid:
+            if results[i]['status'] == 'success':
+                results[i] = {'index': offset + i, 'status': 'fail', 'message': 'Could not save this chunk.'}
+    return results
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Thread-safe LRU cache whose entries also expire after a time-to-live.
+    Counts hits and misses so the hit rate can be reported, and passes each lookup's
+    outcome (True for a hit) to on_lookup if given.
+    """
+
+    def __init__(self, max_size, ttl, on_lookup=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_lookup = on_lookup
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.lookup(key)
+        if self.on_lookup is not None:
+            self.on_lookup(value is not None)
+        return value
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_where(self, predicate):
+        with self.lock:
+            for key in [key for key, (value, _) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class RebuiltIndex(object):
+    """
+    Base of the in-memory indexes loaded from the database.
+
+    The first request to use the index builds it, once however many arrive together.
+    After that, whenever needs_rebuild() says so, it's rebuilt on a background thread
+    while requests keep using the current one. Subclasses implement build(), which loads
+    everything, swaps it in under self.lock and sets built_at.
+    """
+
+    # For thread names and logs
+    name = 'index'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first_build = threading.Lock()
+        self.built_at = None
+        self.rebuilding = False
+
+    def build(self):
+        raise NotImplementedError
+
+    def ttl(self):
+        """
+        :return: seconds after which the index is rebuilt
+        """
+        raise NotImplementedError
+
+    def needs_rebuild(self):
+        return time.monotonic() - self.built_at > self.ttl()
+
+    def warm(self):
+        """
+        Build the index outside of a request, e.g. when a gunicorn worker starts.
+        """
+        # Not at the top: app.routing imports this module before the app exists
+        from app import app
+        try:
+            with app.app_context():
+                self.build()
+        except Exception as e:
+            app.logger.exception('Could not build the %s: %s', self.name, e)
+
+    def rebuild_in_background(self):
+        def rebuild():
+            try:
+                self.warm()
+            finally:
+                self.rebuilding = False
+
+        with self.lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=rebuild, name=self.name.replace(' ', '-'), daemon=True).start()
+
+    def ensure_fresh(self):
+        if self.built_at is None:
+            with self.first_build:
+                if self.built_at is None:
+                    self.build()
+        elif self.needs_rebuild():
+            self.rebuild_in_background()
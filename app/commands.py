@@ -0,0 +1,52 @@
+import click
+
+from app import app
+from app.models import Project
+from app.seed import Dataset
+from app.feed import build_feed
+
+import time
+
+
+@app.cli.command('recount-likes')
+@click.option('--batch-size', default=1000, help='Projects recounted per transaction.')
+def recount_likes(batch_size):
+    """Recompute every project's like_count from the review table."""
+    repaired = Project.recount_likes(batch_size)
+    click.echo('Repaired like_count on %d projects.' % repaired)
+
+
+@app.cli.command('recompute-trending')
+@click.option('--batch-size', default=1000, help='Projects updated per statement.')
+def recompute_trending(batch_size):
+    """Rebuild every project's trending score from the review table."""
+    count = Project.recompute_trending(batch_size)
+    click.echo('Recomputed trending scores for %d projects.' % count)
+
+
+@app.cli.command('build-feed')
+@click.option('--neighbours', default=50, help='Similar projects kept per project.')
+@click.option('--max-user-likes', default=1000, help='Ignore users with more likes than this.')
+def build_feed_command(neighbours, max_user_likes):
+    """Precompute co-like project similarities for /api/feed."""
+    started = time.perf_counter()
+    written = build_feed(neighbours, max_user_likes)
+    click.echo('Wrote %d project similarities in %.1fs.' % (written, time.perf_counter() - started))
+
+
+@app.cli.command('seed')
+@click.option('--users', default=1000, help='Users to create.')
+@click.option('--projects', default=10000, help='Projects to create.')
+@click.option('--tags', default=200, help='Size of the tag vocabulary.')
+@click.option('--likes', default=5.0, help='Average likes per project.')
+@click.option('--batch-size', default=10000, help='Users or projects inserted per transaction.')
+@click.option('--password', default='password', help='Password of every generated user.')
+@click.option('--random-seed', type=int, help='Seed for reproducible data.')
+def seed(users, projects, tags, likes, batch_size, password, random_seed):
+    """Bulk-generate realistic users, projects, tags and likes."""
+    dataset = Dataset(users, projects, tags, likes, random_seed)
+    elapsed = dataset.generate(batch_size, password)
+    for table, count in dataset.counts.items():
+        click.echo('%-8s %10d rows' % (table, count))
+    total = sum(dataset.counts.values())
+    click.echo('Inserted %d rows in %.1fs (%d rows/s).' % (total, elapsed, total / max(elapsed, 1e-9)))
@@ -1,5 +1,7 @@
 from flask import render_template
 from app import app, db
+from app.passwords import PasswordHasherBusy
+from app.util import fail
 
 
 @app.errorhandler(401)
@@ -16,3 +18,10 @@ def not_found_error(error):
 def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    response, code = fail('The server is busy. Please try again in a moment.', 503)
+    response.headers['Retry-After'] = str(app.config['BCRYPT_RETRY_AFTER'])
+    return response, code
@@ -0,0 +1,208 @@
+from collections import Counter, namedtuple
+from sqlalchemy import select, func
+
+from app import app, db
+from app.cache import RebuiltIndex
+from app.models import Project, Review, ProjectSimilarity, CollectionVersion, taggings
+from app.util import bulk_insert
+
+from array import array
+import heapq
+import math
+import time
+
+
+# Personalized feed: item-to-item collaborative filtering over likes.
+#
+# `flask build-feed` computes, offline, each project's most similar projects by co-likes
+# and stores them in project_similarity. Every worker holds that sparse matrix in compact
+# arrays and scores a user's feed by adding up the neighbours of the projects they liked
+# recently. Users without (useful) likes get projects sharing tags with what they liked
+# or made, and failing that, trending projects.
+
+# Most frequent tags of a user's projects and likes used by the cold-start fallback
+AFFINITY_TAGS = 10
+
+
+def compute_similarities(neighbours, max_user_likes):
+    """
+    Cosine similarity of co-likes: likes(i and j) / sqrt(likes(i) * likes(j)).
+    Users with more than max_user_likes likes are left out of the pair counts, since they
+    add a quadratic number of weak pairs.
+    :return: generator of (project_id, similar_id, score), the top neighbours of each project
+    """
+    user_ordinals = {}
+    project_ordinals = {}
+    project_ids = []
+    likers = []
+    liked = []
+    for user_id, project_id in db.session.execute(select(Review.user_id, Review.project_id)):
+        user = user_ordinals.setdefault(user_id, len(user_ordinals))
+        if user == len(liked):
+            liked.append([])
+        project = project_ordinals.setdefault(project_id, len(project_ordinals))
+        if project == len(likers):
+            likers.append([])
+            project_ids.append(project_id)
+        likers[project].append(user)
+        liked[user].append(project)
+
+    for project, users in enumerate(likers):
+        co_likes = Counter()
+        for user in users:
+            if len(liked[user]) <= max_user_likes:
+                co_likes.update(liked[user])
+        del co_likes[project]
+        top = heapq.nlargest(neighbours, (
+            (count / math.sqrt(len(users) * len(likers[other])), other) for other, count in co_likes.items()))
+        for score, other in top:
+            yield project_ids[project], project_ids[other], score
+
+
+def build_feed(neighbours, max_user_likes, batch_size=10000):
+    """
+    Replace project_similarity in one transaction, and tell workers to reload it.
+    :return: number of similarity rows written
+    """
+    session = db.session
+    session.execute(db.delete(ProjectSimilarity))
+    written = 0
+    rows = []
+    for project_id, similar_id, score in compute_similarities(neighbours, max_user_likes):
+        rows.append({'project_id': project_id, 'similar_id': similar_id, 'score': score})
+        if len(rows) >= batch_size:
+            bulk_insert(session.connection(), ProjectSimilarity.__table__, rows)
+            written += len(rows)
+            rows = []
+    bulk_insert(session.connection(), ProjectSimilarity.__table__, rows)
+    written += len(rows)
+    CollectionVersion.bump(session, 'feed')
+    session.commit()
+    return written
+
+
+# Project ordinals by id, project ids by ordinal, and the matrix in CSR-like form: the
+# neighbours of ordinal i are indices[starts[i]:ends[i]], with their scores alongside
+SimilarityMatrix = namedtuple('SimilarityMatrix', ('ordinals', 'project_ids', 'starts', 'ends', 'indices', 'scores'))
+
+
+class FeedModel(RebuiltIndex):
+    """
+    Per-worker copy of project_similarity. Loaded when the worker starts (or on first use)
+    and reloaded in the background when `flask build-feed` publishes a new version, which is
+    checked every FEED_RELOAD_INTERVAL seconds.
+    """
+
+    name = 'feed model'
+
+    def __init__(self):
+        super().__init__()
+        self.matrix = SimilarityMatrix({}, [], array('l'), array('l'), array('l'), array('f'))
+        self.version = None
+        self.checked_at = None
+
+    def build(self):
+        version = CollectionVersion.get('feed')
+        ordinals = {}
+        spans = {}
+        indices = array('l')
+        scores = array('f')
+        rows = db.session.execute(
+            select(ProjectSimilarity.project_id, ProjectSimilarity.similar_id, ProjectSimilarity.score)
+            .order_by(ProjectSimilarity.project_id, ProjectSimilarity.score.desc())
+            .execution_options(yield_per=10000))
+        for project_id, similar_id, score in rows:
+            project = ordinals.setdefault(project_id, len(ordinals))
+            if project not in spans:
+                spans[project] = len(indices)
+            indices.append(ordinals.setdefault(similar_id, len(ordinals)))
+            scores.append(score)
+        starts = array('l', [0]) * len(ordinals)
+        ends = array('l', [0]) * len(ordinals)
+        # Rows arrive grouped by project, so each project's span ends where the next begins
+        boundaries = sorted(spans.items(), key=lambda span: span[1]) + [(None, len(indices))]
+        for (project, start), (_, end) in zip(boundaries, boundaries[1:]):
+            starts[project] = start
+            ends[project] = end
+        project_ids = sorted(ordinals, key=ordinals.get)
+        with self.lock:
+            self.matrix = SimilarityMatrix(ordinals, project_ids, starts, ends, indices, scores)
+            self.version = version
+            self.built_at = self.checked_at = time.monotonic()
+
+    def needs_rebuild(self):
+        if time.monotonic() - self.checked_at <= app.config['FEED_RELOAD_INTERVAL']:
+            return False
+        self.checked_at = time.monotonic()
+        return CollectionVersion.get('feed') != self.version
+
+    def recommend(self, liked_ids, exclude, limit):
+        """
+        Score projects by their similarity to the liked ones.
+        :return: up to limit project ids, best first, leaving out ids in exclude
+        """
+        self.ensure_fresh()
+        matrix = self.matrix
+        totals = {}
+        for project_id in liked_ids:
+            project = matrix.ordinals.get(project_id)
+            if project is None:
+                continue
+            for k in range(matrix.starts[project], matrix.ends[project]):
+                other = matrix.indices[k]
+                totals[other] = totals.get(other, 0.0) + matrix.scores[k]
+        ranked = heapq.nlargest(limit + len(exclude), totals.items(), key=lambda item: item[1])
+        project_ids = (matrix.project_ids[other] for other, _ in ranked)
+        return [project_id for project_id in project_ids if project_id not in exclude][:limit]
+
+
+feed_model = FeedModel()
+
+
+def tag_affinity(seed_ids, exclude, limit):
+    """
+    Cold-start fallback: projects sharing the most common tags of seed_ids (weighted by how
+    common), then trending projects.
+    :return: up to limit project ids, leaving out ids in exclude
+    """
+    project_ids = []
+    weights = {}
+    if seed_ids:
+        weights = dict(db.session.query(taggings.c.tag_name, func.count())
+                       .filter(taggings.c.project_id.in_(seed_ids))
+                       .group_by(taggings.c.tag_name)
+                       .order_by(func.count().desc(), taggings.c.tag_name)
+                       .limit(AFFINITY_TAGS))
+    if weights:
+        matches = (db.session.query(taggings.c.project_id)
+                   .join(Project, Project.id == taggings.c.project_id)
+                   .filter(taggings.c.tag_name.in_(weights)))
+        if exclude:
+            matches = matches.filter(taggings.c.project_id.notin_(exclude))
+        matches = (matches.group_by(taggings.c.project_id)
+                   .order_by(func.sum(db.case(weights, value=taggings.c.tag_name)).desc(),
+                             func.max(Project.trending_score).desc(), taggings.c.project_id)
+                   .limit(limit))
+        project_ids = [row.project_id for row in matches]
+    if len(project_ids) < limit:
+        trending = db.session.query(Project.id).filter(Project.id.notin_(set(exclude) | set(project_ids)))
+        trending = trending.order_by(Project.trending_score.desc(), Project.id).limit(limit - len(project_ids))
+        project_ids += [row.id for row in trending]
+    return project_ids
+
+
+def feed_project_ids(user_id, limit):
+    """
+    A user's feed: projects similar to the ones they liked recently, topped up by the
+    tag affinity fallback. Projects the user made or already liked are left out.
+    :return: up to limit project ids
+    """
+    liked = [row.project_id for row in db.session.query(Review.project_id)
+             .filter_by(user_id=user_id).order_by(Review.created_at.desc(), Review.id.desc())]
+    own = [row.id for row in db.session.query(Project.id).filter_by(user_id=user_id)]
+    exclude = set(liked) | set(own)
+    project_ids = feed_model.recommend(liked[:app.config['FEED_HISTORY']], exclude, limit)
+    if len(project_ids) < limit:
+        seeds = liked[:app.config['FEED_HISTORY']] + own[:app.config['FEED_HISTORY']]
+        project_ids += tag_affinity(seeds, exclude | set(project_ids), limit - len(project_ids))
+    return project_ids
@@ -0,0 +1,129 @@
+from flask import Response, g, request, abort
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+from sqlalchemy import event
+
+from app import app, db
+
+import os
+import time
+
+
+# Prometheus metrics, served at /metrics.
+#
+# Under gunicorn every worker is a separate process with its own counters. When
+# PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py does this) each worker writes its
+# samples to files in that directory and /metrics, whichever worker serves it, adds up
+# the files of all workers. Without it (flask run, tests) the metrics are per process.
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to produce a response, by endpoint.', ['endpoint', 'method'])
+REQUESTS = Counter(
+    'http_requests_total', 'Responses sent, by endpoint and status code.', ['endpoint', 'method', 'status'])
+IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'Requests being handled.', multiprocess_mode='livesum')
+
+POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out', 'Database connections in use.', ['bind'], multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge(
+    'db_pool_overflow', 'Connections open beyond the pool size.', ['bind'], multiprocess_mode='livesum')
+POOL_WAIT = Histogram(
+    'db_pool_wait_seconds', 'Time to get a connection from the pool.', ['bind'],
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30))
+
+PASSWORD_HASHING = Histogram(
+    'password_hashing_seconds', 'Time for a bcrypt hash or check, queueing included.', ['operation'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+PASSWORD_HASHER_BUSY = Counter(
+    'password_hasher_rejected_total', 'Hashes refused because the bcrypt queue was full.')
+
+RATE_LIMITED = Counter(
+    'http_requests_rate_limited_total', 'Requests refused by rate limits, by budget and key.', ['budget', 'key'])
+
+CACHE_LOOKUPS = Counter(
+    'cache_lookups_total', 'Lookups in in-process caches, by outcome.', ['cache', 'result'])
+
+
+def cache_lookup(name):
+    """
+    :return: on_lookup callback for a TTLCache, counting its hits and misses as cache name
+    """
+    hits = CACHE_LOOKUPS.labels(name, 'hit')
+    misses = CACHE_LOOKUPS.labels(name, 'miss')
+
+    def on_lookup(hit):
+        (hits if hit else misses).inc()
+    return on_lookup
+
+
+@app.before_request
+def start_request():
+    g.metrics_started = time.perf_counter()
+    IN_FLIGHT.inc()
+
+
+@app.after_request
+def observe_request(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        endpoint = request.endpoint or 'none'
+        REQUEST_LATENCY.labels(endpoint, request.method).observe(time.perf_counter() - started)
+        REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+    return response
+
+
+@app.teardown_request
+def finish_request(exception):
+    if g.pop('metrics_started', None) is not None:
+        IN_FLIGHT.dec()
+
+
+def instrument_pool(bind, engine):
+    pool = engine.pool
+    if not hasattr(pool, 'overflow'):
+        # SingletonThreadPool/NullPool have no size to report
+        return
+    checked_out = POOL_CHECKED_OUT.labels(bind)
+    overflow = POOL_OVERFLOW.labels(bind)
+    wait = POOL_WAIT.labels(bind)
+
+    def on_checkout(*args):
+        checked_out.set(pool.checkedout())
+        overflow.set(max(0, pool.overflow()))
+
+    def on_checkin(*args):
+        # Fires just before the connection is handed back
+        checked_out.set(pool.checkedout() - 1)
+        overflow.set(max(0, pool.overflow()))
+
+    event.listen(pool, 'checkout', on_checkout)
+    event.listen(pool, 'checkin', on_checkin)
+
+    # There's no event for "about to check out", so time the pool's own getter
+    do_get = pool._do_get
+
+    def timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            wait.observe(time.perf_counter() - started)
+    pool._do_get = timed_do_get
+
+
+with app.app_context():
+    for bind, engine in db.engines.items():
+        instrument_pool(bind or 'default', engine)
+
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(401)
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
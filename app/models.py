@@ -1,7 +1,11 @@
-from app import app, db, bcrypt
-from app.util import get_now
+from sqlalchemy import event
+
+from app import app, db
+from app.util import get_now, compile_serializer, insert_or_ignore
+from app.passwords import password_hasher, hash_rounds
 import jwt
 import datetime
+import time
 import uuid
 
 
@@ -9,24 +13,32 @@ import uuid
 taggings = db.Table('tagging',
     db.Column('project_id', db.String, db.ForeignKey('project.id'), nullable=False),
     db.Column('tag_name', db.String, db.ForeignKey('tag.name'), nullable=False),
+    db.Index('uq_tagging_project_id_tag_name', 'project_id', 'tag_name', unique=True),
+    db.Index('ix_tagging_tag_name', 'tag_name'),
 )
 
 
 class User(db.Model):
     __tablename__ = 'user'
     __serializable__ = ('id', 'username', 'email', 'first_name', 'last_name')
+    __table_args__ = (
+        # Keyset pagination order
+        db.Index('ix_user_registered_at_id', 'registered_at', 'id'),
+    )
 
     id = db.Column(db.String, primary_key=True)
     username = db.Column(db.String)
-    email = db.Column(db.String)
+    email = db.Column(db.String, index=True, unique=True)
     first_name = db.Column(db.String)
     last_name = db.Column(db.String)
     admin = db.Column(db.Boolean, default=False)
     password = db.Column(db.String(255), nullable=False)
     confirmed = db.Column(db.Boolean)
 
-    registered_at = db.Column(db.Integer)
+    registered_at = db.Column(db.Integer, nullable=False)
     last_seen = db.Column(db.Integer)
+    # Bumped on every change, for ETags
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     projects = db.relationship('Project', cascade='all,delete', back_populates='user')
     reviews = db.relationship('Review', cascade='all,delete', back_populates='user')
@@ -44,12 +56,16 @@ class User(db.Model):
         self.last_seen = get_now()
 
     def is_password_correct(self, password: str) -> bool:
-        return bcrypt.check_password_hash(self.password, password)
+        return password_hasher.check(self.password, password)
 
     def set_password(self, password):
-        self.password = bcrypt.generate_password_hash(
-            password, app.config.get('BCRYPT_LOG_ROUNDS')
-        ).decode()
+        self.password = password_hasher.hash(password)
+
+    def needs_rehash(self) -> bool:
+        """
+        Whether the password hash was made with a different cost than BCRYPT_LOG_ROUNDS.
+        """
+        return hash_rounds(self.password) != app.config['BCRYPT_LOG_ROUNDS']
 
     def generate_token(self):
         """
@@ -60,12 +76,6 @@ class User(db.Model):
             'iat': get_now(),
             'sub': self.id,
         }
-        print(jwt.encode(
-            payload,
-            app.config.get('SECRET_KEY'),
-            algorithm='HS256'
-        ))
-
         return jwt.encode(
             payload,
             app.config.get('SECRET_KEY'),
@@ -73,25 +83,43 @@ class User(db.Model):
         )
 
     @staticmethod
-    def from_token(token):
+    def decode_token(token):
         """
         Decode/validate an auth token.
         :param token: token to decode.
-        :return: User whose token this is, or None if token invalid/no user associated
+        :return: token payload, or None if token invalid
         """
         try:
-            payload = jwt.decode(token, app.config.get('SECRET_KEY'), algorithms=['HS256'])
-            return User.query.get(payload['sub'])
+            return jwt.decode(token, app.config.get('SECRET_KEY'), algorithms=['HS256'])
         except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
             # Signature expired, or token otherwise invalid
             return None
 
+    @staticmethod
+    def from_token(token):
+        """
+        Decode/validate an auth token.
+        :param token: token to decode.
+        :return: User whose token this is, or None if token invalid/no user associated
+        """
+        payload = User.decode_token(token)
+        if payload is None:
+            return None
+        return User.query.get(payload['sub'])
+
 
 class Project(db.Model):
     __tablename__ = 'project'
     __serializable__ = ('id', 'name', 'description', 'image_url', 'github_url', 'like_count', 'user')
     __editable__ = {'name', 'description', 'image_url', 'github_url'}
     _to_expand = {'user'}
+    # Keys of extra_props(), which clients may also ask for with ?fields=
+    __extra_props__ = ('tags',)
+    __table_args__ = (
+        # Keyset pagination order, overall and per user
+        db.Index('ix_project_created_at_id', 'created_at', 'id'),
+        db.Index('ix_project_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.String, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -99,16 +127,20 @@ class Project(db.Model):
     image_url = db.Column(db.String)
     github_url = db.Column(db.String)
     like_count = db.Column(db.Integer, default=0)
+    # Sum of trending_weight() over the project's likes; see Project.trending_weight
+    trending_score = db.Column(db.Float, nullable=False, default=0, server_default='0', index=True)
 
-    created_at = db.Column(db.Integer)
+    created_at = db.Column(db.Integer, nullable=False)
     updated_at = db.Column(db.Integer)
+    # Bumped on every change, for ETags
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     user_id = db.Column(db.String, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', back_populates='projects')
 
     reviews = db.relationship('Review', cascade='all,delete', back_populates='project')
     tags = db.relationship(
-        'Tag', secondary=taggings, lazy='subquery',
+        'Tag', secondary=taggings,
         backref=db.backref('projects', lazy=True))
 
     def update(self, new_values):
@@ -116,8 +148,13 @@ class Project(db.Model):
         for key, value in accepted_values.items():
             setattr(self, key, value)
 
+    def is_hosted_by(self, user) -> bool:
+        return self.user_id == user.id
+
     def has_tag(self, tag_name) -> bool:
-        return self.tags.filter(taggings.c.tag_name == tag_name).count() > 0
+        return db.session.query(
+            db.select(taggings).filter_by(project_id=self.id, tag_name=tag_name).exists()
+        ).scalar()
 
     def add_tag(self, tag_name) -> bool:
         tag = Tag.query.get(tag_name)
@@ -129,14 +166,97 @@ class Project(db.Model):
         self.tags.append(tag)
         return True
 
+    def set_tags(self, tag_names, resolved=None):
+        """
+        Make the project's tags exactly tag_names (case-insensitive).
+        Only tags that changed are added or removed, and new tags are created in bulk,
+        so the number of statements doesn't grow with the number of tags.
+        :param resolved: optional dict of already resolved Tags by name, to skip Tag.resolve
+        """
+        names = {name.strip().lower() for name in tag_names if name.strip()}
+        # Flush the project once, with all of its tag changes, at commit
+        with db.session.no_autoflush:
+            current = {tag.name: tag for tag in self.tags}
+            for name in current.keys() - names:
+                self.tags.remove(current[name])
+            added = names - current.keys()
+            if added and resolved is not None:
+                self.tags.extend(resolved[name] for name in added)
+            elif added:
+                self.tags.extend(Tag.resolve(added))
+
     def remove_tag(self, tag_name) -> bool:
         tag = Tag.query.get(tag_name)
         self.tags.remove(tag)
         return True
 
-    def update_like_count(self):
-        self.like_count = len(self.reviews)
+    @staticmethod
+    def trending_weight(liked_at) -> float:
+        """
+        How much a like given at liked_at counts towards trending_score.
+
+        A like's influence should halve every TRENDING_HALF_LIFE seconds. Rather than decay
+        every score as time passes, newer likes are weighted up by the same factor relative
+        to TRENDING_EPOCH: ordering by the stored sums then equals ordering by decayed score
+        at any moment, and each like only needs an atomic += on its project.
+        """
+        if liked_at is None:
+            return 0.0
+        return 2.0 ** ((liked_at - app.config['TRENDING_EPOCH']) / app.config['TRENDING_HALF_LIFE'])
+
+    @staticmethod
+    def recompute_trending(batch_size=1000) -> int:
+        """
+        Rebuild trending_score for every project from the review table.
+        :return: number of projects with likes
+        """
+        scores = {}
+        reviews = db.session.query(Review.project_id, Review.created_at).yield_per(batch_size)
+        for project_id, created_at in reviews:
+            scores[project_id] = scores.get(project_id, 0.0) + Project.trending_weight(created_at)
+        db.session.execute(db.update(Project).values(trending_score=0))
+        items = list(scores.items())
+        for start in range(0, len(items), batch_size):
+            chunk = dict(items[start:start + batch_size])
+            db.session.execute(
+                db.update(Project)
+                .where(Project.id.in_(chunk))
+                .values(trending_score=db.case(chunk, value=Project.id))
+            )
         db.session.commit()
+        return len(scores)
+
+    @staticmethod
+    def recount_likes(batch_size=1000) -> int:
+        """
+        Repair like_count for every project from the review table.
+        Works through projects in id order, one GROUP BY and at most one UPDATE per batch.
+        :return: number of projects whose count was wrong
+        """
+        repaired = 0
+        last_id = None
+        while True:
+            batch = db.session.query(Project.id, Project.like_count)
+            if last_id is not None:
+                batch = batch.filter(Project.id > last_id)
+            batch = batch.order_by(Project.id).limit(batch_size).all()
+            if not batch:
+                return repaired
+            last_id = batch[-1].id
+            counts = dict(
+                db.session.query(Review.project_id, db.func.count())
+                .filter(Review.project_id.in_([row.id for row in batch]))
+                .group_by(Review.project_id)
+            )
+            wrong = {row.id: counts.get(row.id, 0) for row in batch if row.like_count != counts.get(row.id, 0)}
+            if wrong:
+                db.session.execute(
+                    db.update(Project)
+                    .where(Project.id.in_(wrong))
+                    .values(like_count=db.case(wrong, value=Project.id))
+                )
+                repaired += len(wrong)
+            db.session.commit()
 
     def extra_props(self):
         return {
@@ -149,10 +269,26 @@ class Tag(db.Model):
 
     name = db.Column(db.String(32), primary_key=True)
 
+    @staticmethod
+    def resolve(names):
+        """
+        Get the tags with the given names, creating any that don't exist yet.
+        One query for the existing tags, plus one multi-row insert and one query for the rest.
+        """
+        tags = Tag.query.filter(Tag.name.in_(names)).all()
+        missing = set(names) - {tag.name for tag in tags}
+        if missing:
+            insert_or_ignore(db.session, Tag.__table__, [{'name': name} for name in sorted(missing)])
+            tags += Tag.query.filter(Tag.name.in_(missing)).all()
+        return tags
+
 
 class Review(db.Model):
     __tablename__ = 'review'
     __serializable__ = ('id', 'user_id', 'project_id')
+    __table_args__ = (
+        db.Index('uq_review_user_id_project_id', 'user_id', 'project_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
 
@@ -162,5 +298,141 @@ class Review(db.Model):
     user_id = db.Column(db.String, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship('User', back_populates='reviews')
 
-    project_id = db.Column(db.String, db.ForeignKey('project.id'), nullable=False)
+    project_id = db.Column(db.String, db.ForeignKey('project.id'), nullable=False, index=True)
     project = db.relationship('Project', back_populates='reviews')
+
+    @staticmethod
+    def like(user_id, project_id):
+        """
+        Record that a user likes a project, bumping its like_count in the same transaction.
+        Liking a project twice has no effect.
+        :return: the project's like_count, or None if there is no such project
+        """
+        project = db.session.query(Project.like_count).filter_by(id=project_id).first()
+        if project is None:
+            return None
+        like_count = project.like_count
+        now = get_now()
+        if insert_or_ignore(db.session, Review.__table__, [
+            {'user_id': user_id, 'project_id': project_id, 'created_at': now},
+        ]):
+            like_count = Review.bump_like_count(project_id, 1, Project.trending_weight(now))
+        return like_count or 0
+
+    @staticmethod
+    def unlike(user_id, project_id):
+        """
+        Remove a user's like from a project, lowering its like_count in the same transaction.
+        :return: the project's like_count, or None if the user didn't like the project
+        """
+        deleted = db.session.execute(
+            db.delete(Review)
+            .where(Review.user_id == user_id, Review.project_id == project_id)
+            .returning(Review.created_at)
+        ).first()
+        if deleted is None:
+            return None
+        return Review.bump_like_count(project_id, -1, -Project.trending_weight(deleted.created_at))
+
+    @staticmethod
+    def bump_like_count(project_id, amount, trending_weight):
+        like_count = db.session.execute(
+            db.update(Project)
+            .where(Project.id == project_id)
+            .values(like_count=db.func.coalesce(Project.like_count, 0) + amount,
+                    trending_score=Project.trending_score + trending_weight,
+                    version=Project.version + 1)
+            .returning(Project.like_count)
+        ).scalar()
+        CollectionVersion.bump(db.session, 'projects')
+        return like_count
+
+
+class ProjectSimilarity(db.Model):
+    """
+    Item-to-item co-like similarity: each project's closest neighbours, by the cosine of
+    the sets of users who liked them. Rebuilt as a whole by `flask build-feed`.
+    """
+    __tablename__ = 'project_similarity'
+
+    project_id = db.Column(db.String, db.ForeignKey('project.id', ondelete='CASCADE'), primary_key=True)
+    similar_id = db.Column(db.String, db.ForeignKey('project.id', ondelete='CASCADE'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+
+
+class CollectionVersion(db.Model):
+    """
+    Version of a whole collection ('projects', 'users'), used as the ETag of listings: the
+    highest id logged for its name. Bumps only insert rows, so concurrent writers never wait
+    on each other the way they would updating one counter row.
+    """
+    __tablename__ = 'collection_version'
+    __table_args__ = (db.Index('ix_collection_version_name_id', 'name', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(32), nullable=False)
+
+    # Seconds between sweeps of superseded rows, per process
+    cleanup_interval = 60
+    cleaned_at = 0
+
+    @staticmethod
+    def get(name) -> int:
+        return db.session.query(db.func.max(CollectionVersion.id)).filter_by(name=name).scalar() or 0
+
+    @staticmethod
+    def bump(session, name):
+        """
+        Bump the collection's version once session commits.
+        """
+        session.info.setdefault('bumped_collections', set()).add(name)
+
+    @staticmethod
+    def log(names):
+        table = CollectionVersion.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), [{'name': name} for name in sorted(names)])
+            if time.monotonic() - CollectionVersion.cleaned_at > CollectionVersion.cleanup_interval:
+                latest = table.alias('latest')
+                connection.execute(table.delete().where(table.c.id < (
+                    db.select(db.func.max(latest.c.id)).where(latest.c.name == table.c.name).scalar_subquery())))
+                CollectionVersion.cleaned_at = time.monotonic()
+
+
+@event.listens_for(User, 'before_update')
+@event.listens_for(Project, 'before_update')
+def bump_version(mapper, connection, target):
+    # Also fires when only a relationship such as Project.tags changed. Incremented by the
+    # database, like Review.bump_like_count, so concurrent writers can't both get n + 1.
+    target.version = type(target).version + 1
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_collection_versions(session, flush_context):
+    changed = session.new | session.dirty | session.deleted
+    users = any(isinstance(obj, User) for obj in changed)
+    # Projects embed their user, so user changes invalidate project listings too
+    projects = users or any(isinstance(obj, Project) for obj in changed)
+    if users:
+        CollectionVersion.bump(session, 'users')
+    if projects:
+        CollectionVersion.bump(session, 'projects')
+
+
+@event.listens_for(db.session, 'after_commit')
+def log_collection_versions(session):
+    # Only once the changes are visible: ids are handed out in insert order, not commit
+    # order, so a version logged inside the transaction could show before its changes
+    # and leave their listings cached under it
+    names = session.info.pop('bumped_collections', None)
+    if names:
+        CollectionVersion.log(names)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_collection_versions(session):
+    session.info.pop('bumped_collections', None)
+
+
+for model in (User, Project, Review):
+    compile_serializer(model)
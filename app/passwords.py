@@ -0,0 +1,102 @@
+from app import app, bcrypt
+from app.metrics import PASSWORD_HASHING, PASSWORD_HASHER_BUSY
+from app.store import shared_store
+
+import time
+import uuid
+
+
+# Seconds between checks for a free slot while queued: doubling from POLL_INTERVAL up to
+# MAX_POLL_INTERVAL, so waiters don't crowd the shared store's write lock. A hash of
+# cost 12 takes a few hundred milliseconds anyway.
+POLL_INTERVAL = 0.02
+MAX_POLL_INTERVAL = 0.2
+# Longest a request waits in the queue, holding its worker, before it's refused after all
+QUEUE_TIMEOUT = 3
+# Slots not released or refreshed for this long belong to a process that died
+STALE_SLOT = 30
+
+
+class PasswordHasherBusy(Exception):
+    """
+    Raised when too many password hashes are already running or queued.
+    """
+
+
+class PasswordHasher(object):
+    """
+    Bounds the bcrypt work of the whole server, whatever the number of gunicorn workers.
+
+    At most BCRYPT_WORKERS hashes run at once across all workers and BCRYPT_QUEUE_DEPTH
+    more requests may wait for a turn; anything beyond that is refused immediately with
+    PasswordHasherBusy instead of piling up behind a login burst and tying up every
+    worker. Running and waiting hashes are rows of the shared store's hash_slot table.
+    """
+
+    def claim(self, token, queued):
+        """
+        Take a running slot if one is free, or with queued False, a place in the queue.
+        :return: True if running, False if queued
+        """
+        now = time.time()
+        with shared_store.transaction() as connection:
+            connection.execute('DELETE FROM hash_slot WHERE updated < ?', (now - STALE_SLOT,))
+            running, waiting = connection.execute(
+                'SELECT count(*) FILTER (WHERE running), count(*) FILTER (WHERE NOT running) FROM hash_slot').fetchone()
+            if queued:
+                waiting -= 1
+            if running < app.config['BCRYPT_WORKERS']:
+                connection.execute('INSERT OR REPLACE INTO hash_slot VALUES (?, 1, ?)', (token, now))
+                return True
+            if queued:
+                connection.execute('UPDATE hash_slot SET updated = ? WHERE token = ?', (now, token))
+            elif waiting < app.config['BCRYPT_QUEUE_DEPTH']:
+                connection.execute('INSERT INTO hash_slot VALUES (?, 0, ?)', (token, now))
+            else:
+                raise PasswordHasherBusy()
+            return False
+
+    def release(self, token):
+        with shared_store.statements() as connection:
+            connection.execute('DELETE FROM hash_slot WHERE token = ?', (token,))
+
+    def run(self, operation, fn, *args):
+        token = uuid.uuid4().hex
+        started = time.perf_counter()
+        try:
+            queued = False
+            interval = POLL_INTERVAL
+            while not self.claim(token, queued):
+                queued = True
+                if time.perf_counter() - started + interval > QUEUE_TIMEOUT:
+                    raise PasswordHasherBusy()
+                time.sleep(interval)
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+        except PasswordHasherBusy:
+            self.release(token)
+            PASSWORD_HASHER_BUSY.inc()
+            raise
+        try:
+            return fn(*args)
+        finally:
+            self.release(token)
+            PASSWORD_HASHING.labels(operation).observe(time.perf_counter() - started)
+
+    def hash(self, password) -> str:
+        return self.run('hash', bcrypt.generate_password_hash, password, app.config['BCRYPT_LOG_ROUNDS']).decode()
+
+    def check(self, pw_hash, password) -> bool:
+        return self.run('check', bcrypt.check_password_hash, pw_hash, password)
+
+
+password_hasher = PasswordHasher()
+
+
+def hash_rounds(pw_hash) -> int:
+    """
+    Cost factor a bcrypt hash was made with, e.g. 12 for '$2b$12$...'.
+    """
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return 0
@@ -0,0 +1,116 @@
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from app import app, db
+from app.cache import TTLCache
+from app.metrics import cache_lookup
+from app.models import User
+from app.store import shared_store
+
+import time
+
+
+# What a request needs to know about the authenticated user, and when it was read
+Principal = namedtuple('Principal', ('id', 'admin', 'email', 'verified_at'))
+
+# Verified tokens, so most authenticated requests touch neither jwt nor the database.
+# When a user is deleted or their password, admin flag or email changes, the commit
+# records a revocation in the shared store; every worker checks it on a cache hit.
+principal_cache = TTLCache(app.config['AUTH_CACHE_SIZE'], app.config['AUTH_CACHE_TTL'], cache_lookup('principals'))
+
+
+class Revocations(object):
+    """
+    When users' cached principals stopped being valid, for all workers to see.
+    """
+
+    # Seconds between sweeps of revocations older than any cache entry
+    cleanup_interval = 60
+
+    def __init__(self, store):
+        self.store = store
+        self.cleaned_at = time.time()
+
+    def revoke(self, user_ids):
+        now = time.time()
+        with self.store.statements() as connection:
+            if now - self.cleaned_at > self.cleanup_interval:
+                connection.execute('DELETE FROM revoked_principal WHERE revoked_at < ?',
+                                   (now - app.config['AUTH_CACHE_TTL'],))
+                self.cleaned_at = now
+            connection.executemany('INSERT OR REPLACE INTO revoked_principal VALUES (?, ?)',
+                                   [(user_id, now) for user_id in user_ids])
+
+    def revoked_since(self, user_id, since):
+        with self.store.statements() as connection:
+            row = connection.execute('SELECT revoked_at FROM revoked_principal WHERE user_id = ?', (user_id,)).fetchone()
+        return row is not None and row[0] >= since
+
+
+revocations = Revocations(shared_store)
+
+
+def authenticate(token):
+    """
+    Find who an auth token belongs to.
+    :param token: token to verify.
+    :return: Principal for the token's user, or None if the token is invalid/the user is gone
+    """
+    principal = principal_cache.get(token)
+    if principal is not None:
+        if not revocations.revoked_since(principal.id, principal.verified_at):
+            return principal
+        principal_cache.discard(token)
+    # Taken before reading the user, so a change committed meanwhile still revokes this
+    verified_at = time.time()
+    payload = User.decode_token(token)
+    if payload is None:
+        return None
+    user = db.session.get(User, payload['sub'])
+    if user is None:
+        return None
+    principal = Principal(id=user.id, admin=bool(user.admin), email=user.email, verified_at=verified_at)
+    ttl = None
+    if 'exp' in payload:
+        # Never serve a token from the cache past its expiry
+        ttl = payload['exp'] - time.time()
+    principal_cache.set(token, principal, ttl)
+    return principal
+
+
+def invalidate_users(user_ids):
+    revocations.revoke(user_ids)
+    principal_cache.discard_where(lambda principal: principal.id in user_ids)
+
+
+def invalidate_on_commit(user):
+    # Once committed: other workers could otherwise cache the old row again meanwhile
+    session = object_session(user)
+    if session is not None:
+        session.info.setdefault('revoked_principals', set()).add(user.id)
+
+
+@event.listens_for(User.password, 'set')
+@event.listens_for(User.admin, 'set')
+@event.listens_for(User.email, 'set')
+def on_credentials_changed(user, value, old_value, initiator):
+    if user.id is not None and value != old_value:
+        invalidate_on_commit(user)
+
+
+@event.listens_for(User, 'after_delete')
+def on_user_deleted(mapper, connection, user):
+    invalidate_on_commit(user)
+
+
+@event.listens_for(db.session, 'after_commit')
+def on_commit(session):
+    user_ids = session.info.pop('revoked_principals', None)
+    if user_ids:
+        invalidate_users(user_ids)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def on_rollback(session):
+    session.info.pop('revoked_principals', None)
@@ -0,0 +1,136 @@
+from flask import request
+
+from app import app
+from app.metrics import RATE_LIMITED
+from app.store import shared_store
+from app.util import fail
+
+import math
+import sqlite3
+import time
+
+
+# Token-bucket rate limits, checked before any other work on a request.
+#
+# A budget of (requests, seconds) is a bucket holding up to `requests` tokens that refills
+# at requests / seconds tokens a second; each request takes a token or is refused with
+# 429 and a Retry-After header. Buckets are kept per route and per client IP, and for the
+# auth routes also per account email, so spreading a password guessing run over many
+# addresses doesn't help either.
+#
+# Buckets are rows in the shared store (app/store.py), so under gunicorn the limits hold
+# for the whole server; a check is a single UPSERT, a few tens of microseconds.
+
+# Methods that count against the budgets of /api routes
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+# Budget of /api writes not listed in RATE_LIMITS by endpoint
+API_WRITE_BUDGET = 'api.write'
+# Seconds between sweeps of buckets that have refilled completely
+CLEANUP_INTERVAL = 60
+
+TAKE = '''
+INSERT INTO bucket (key, tokens, updated) VALUES (:key, :capacity - 1, :now)
+ON CONFLICT (key) DO UPDATE SET
+    tokens = min(:capacity, tokens + (:now - updated) * :rate) - 1,
+    updated = :now
+WHERE min(:capacity, tokens + (:now - updated) * :rate) >= 1
+RETURNING tokens
+'''
+
+
+class Buckets(object):
+    """
+    Token buckets, kept in the shared store.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.cleaned_at = time.time()
+
+    def take(self, key, requests, seconds):
+        """
+        Take a token from the bucket for key, which holds requests tokens and refills over seconds.
+        :return: 0 if a token was taken, else the seconds until one will be available
+        """
+        now = time.time()
+        rate = requests / seconds
+        with self.store.statements() as connection:
+            if now - self.cleaned_at > CLEANUP_INTERVAL:
+                self.cleanup(connection, now)
+            params = {'key': key, 'capacity': requests, 'rate': rate, 'now': now}
+            if connection.execute(TAKE, params).fetchone() is not None:
+                return 0
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return 0
+        tokens = min(requests, row[0] + (now - row[1]) * rate)
+        return max(0, (1 - tokens) / rate)
+
+    def cleanup(self, connection, now):
+        # A bucket left alone for the longest budget period is full, the same as no bucket
+        longest = max(seconds for budgets in app.config['RATE_LIMITS'].values() for _, seconds in budgets.values())
+        connection.execute('DELETE FROM bucket WHERE updated < ?', (now - longest,))
+        self.cleaned_at = now
+
+
+buckets = Buckets(shared_store)
+
+
+def client_ip():
+    """
+    :return: the client's address, looking through RATE_LIMIT_PROXIES proxies' X-Forwarded-For
+    """
+    proxies = app.config['RATE_LIMIT_PROXIES']
+    route = request.access_route
+    if proxies and len(route) >= proxies:
+        return route[-proxies]
+    return request.remote_addr
+
+
+def request_email():
+    payload = request.get_json(force=True, silent=True)
+    if isinstance(payload, dict) and isinstance(payload.get('email'), str):
+        return payload['email'].lower().strip()
+    return None
+
+
+def budget_name():
+    """
+    :return: the RATE_LIMITS entry that applies to this request, or None
+    """
+    if request.method not in WRITE_METHODS:
+        return None
+    limits = app.config['RATE_LIMITS']
+    if request.endpoint in limits:
+        return request.endpoint
+    if request.blueprint == 'api':
+        return API_WRITE_BUDGET
+    return None
+
+
+@app.before_request
+def check_rate_limits():
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return None
+    name = budget_name()
+    if name is None:
+        return None
+    wait = 0
+    for key, (requests, seconds) in app.config['RATE_LIMITS'][name].items():
+        value = client_ip() if key == 'ip' else request_email()
+        if value is None:
+            continue
+        try:
+            wait = buckets.take('%s:%s:%s' % (name, key, value), requests, seconds)
+        except sqlite3.Error as e:
+            # Better to serve without limits than to fail every request
+            app.logger.exception('Could not check rate limits: %s', e)
+            return None
+        if wait:
+            RATE_LIMITED.labels(name, key).inc()
+            break
+    if not wait:
+        return None
+    response, code = fail('Too many requests. Please try again later.', 429)
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response, code
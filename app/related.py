@@ -0,0 +1,198 @@
+from sqlalchemy import event, select
+
+from app import app, db
+from app.cache import RebuiltIndex
+from app.models import Project, taggings
+
+import heapq
+import math
+import random
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# MinHash signature length, split into LSH_BANDS bands of SIGNATURE_SIZE // LSH_BANDS rows.
+# Two projects whose tag sets have Jaccard similarity s share at least one band with
+# probability 1 - (1 - s ** 4) ** 16: about 0.98 at s = 0.5, 0.05 at s = 0.2.
+SIGNATURE_SIZE = 64
+LSH_BANDS = 16
+ROWS_PER_BAND = SIGNATURE_SIZE // LSH_BANDS
+# Hash functions h(x) = (a * x + b) mod PRIME; fixed seed so every worker agrees
+PRIME = (1 << 31) - 1
+_random = random.Random(419)
+HASH_A = [_random.randrange(1, PRIME) for _ in range(SIGNATURE_SIZE)]
+HASH_B = [_random.randrange(0, PRIME) for _ in range(SIGNATURE_SIZE)]
+# A band's bucket key is the dot product of its rows with these (exact in 63 bits)
+BAND_MULTIPLIERS = [_random.randrange(1, 1 << 30) for _ in range(ROWS_PER_BAND)]
+# Only this many of the most similar candidates are re-ranked by like_count
+WEIGHTED_CANDIDATES = 200
+
+
+def tag_hash(name):
+    return zlib.crc32(name.encode()) % PRIME
+
+
+def signature(tag_names):
+    values = [tag_hash(name) for name in tag_names]
+    return [min((a * x + b) % PRIME for x in values) for a, b in zip(HASH_A, HASH_B)]
+
+
+def band_keys(tag_names):
+    """
+    :return: the LSH bucket key of each band of tag_names' MinHash signature
+    """
+    sig = signature(tag_names)
+    return [sum(value * multiplier for value, multiplier in zip(sig[band * ROWS_PER_BAND:], BAND_MULTIPLIERS))
+            for band in range(LSH_BANDS)]
+
+
+def band_keys_many(tag_lists):
+    """
+    band_keys() for many (non-empty) tag sets at once, vectorized with NumPy if it's installed.
+    :return: list of band key lists, in the order of tag_lists
+    """
+    if numpy is None:
+        return [band_keys(names) for names in tag_lists]
+    if not tag_lists:
+        # reduceat can't take an empty array
+        return []
+    names = sorted({name for tag_list in tag_lists for name in tag_list})
+    ordinals = {name: i for i, name in enumerate(names)}
+    # One row of SIGNATURE_SIZE hash values per distinct tag...
+    x = numpy.array([tag_hash(name) for name in names], dtype=numpy.int64)[:, None]
+    hashed = (numpy.array(HASH_A, dtype=numpy.int64) * x + numpy.array(HASH_B, dtype=numpy.int64)) % PRIME
+    # ...gathered for every (project, tag) pair and reduced to a column-wise min per project
+    rows = numpy.array([ordinals[name] for tag_list in tag_lists for name in tag_list], dtype=numpy.int64)
+    starts = numpy.cumsum([0] + [len(tag_list) for tag_list in tag_lists[:-1]])
+    signatures = numpy.minimum.reduceat(hashed[rows], starts, axis=0)
+    bands = signatures.reshape(len(tag_lists), LSH_BANDS, ROWS_PER_BAND)
+    return (bands @ numpy.array(BAND_MULTIPLIERS, dtype=numpy.int64)).tolist()
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+
+class RelatedIndex(RebuiltIndex):
+    """
+    In-memory MinHash/LSH index of project tag sets, for finding projects with similar tags.
+
+    Every tagged project gets a MinHash signature; projects sharing a bucket with the query
+    project in any LSH band are the candidates, ranked by the exact Jaccard similarity of
+    their tag sets. Like tag_index it's built from the database on first use and updated
+    straight away by Project.tags changes in this process. To pick up other workers'
+    changes it's rebuilt every RELATED_INDEX_TTL seconds on a background thread, while
+    requests keep using the previous index.
+    """
+
+    name = 'related projects index'
+
+    def __init__(self):
+        super().__init__()
+        self.tags = {}
+        self.keys = {}
+        self.buckets = [{} for _ in range(LSH_BANDS)]
+
+    def build(self):
+        tags = {}
+        for project_id, tag_name in db.session.execute(select(taggings.c.project_id, taggings.c.tag_name)):
+            tags.setdefault(project_id, set()).add(tag_name)
+        keys = dict(zip(tags, band_keys_many([sorted(names) for names in tags.values()])))
+        buckets = [{} for _ in range(LSH_BANDS)]
+        for project_id, project_keys in keys.items():
+            for band, key in zip(buckets, project_keys):
+                band.setdefault(key, set()).add(project_id)
+        with self.lock:
+            self.tags = tags
+            self.keys = keys
+            self.buckets = buckets
+            self.built_at = time.monotonic()
+
+    def ttl(self):
+        return app.config['RELATED_INDEX_TTL']
+
+    def unbucket(self, project_id):
+        for band, key in zip(self.buckets, self.keys.pop(project_id, ())):
+            bucket = band[key]
+            bucket.discard(project_id)
+            if not bucket:
+                del band[key]
+
+    def update(self, project_id, added=(), removed=()):
+        with self.lock:
+            if self.built_at is None:
+                return
+            names = (self.tags.get(project_id, set()) | set(added)) - set(removed)
+            self.unbucket(project_id)
+            if not names:
+                self.tags.pop(project_id, None)
+                return
+            self.tags[project_id] = names
+            self.keys[project_id] = band_keys(names)
+            for band, key in zip(self.buckets, self.keys[project_id]):
+                band.setdefault(key, set()).add(project_id)
+
+    def remove(self, project_id):
+        with self.lock:
+            self.tags.pop(project_id, None)
+            self.unbucket(project_id)
+
+    def similar(self, project_id):
+        """
+        :return: list of (similarity, project id) for projects with tags like project_id's
+        """
+        self.ensure_fresh()
+        with self.lock:
+            names = self.tags.get(project_id)
+            if not names:
+                return []
+            candidates = set()
+            for band, key in zip(self.buckets, self.keys[project_id]):
+                candidates |= band[key]
+            candidates.discard(project_id)
+            return [(jaccard(names, self.tags[candidate]), candidate) for candidate in candidates]
+
+
+related_index = RelatedIndex()
+
+
+def most_similar(scored, limit):
+    return heapq.nsmallest(limit, scored, key=lambda item: (-item[0], item[1]))
+
+
+def related_project_ids(project_id, limit, weight_likes=False):
+    """
+    Projects whose tags are most like project_id's, optionally favouring well-liked ones:
+    the WEIGHTED_CANDIDATES most similar are then re-ranked by similarity * (1 + ln(1 + like_count)).
+    :return: up to limit project ids, most related first
+    """
+    scored = related_index.similar(project_id)
+    if weight_likes and scored:
+        scored = most_similar(scored, max(limit, WEIGHTED_CANDIDATES))
+        likes = dict(db.session.query(Project.id, Project.like_count)
+                     .filter(Project.id.in_([candidate for _, candidate in scored])))
+        scored = [(similarity * (1 + math.log1p(likes.get(candidate) or 0)), candidate)
+                  for similarity, candidate in scored]
+    return [candidate for _, candidate in most_similar(scored, limit)]
+
+
+@event.listens_for(Project.tags, 'append')
+def on_tag_added(project, tag, initiator):
+    if project.id is not None:
+        related_index.update(project.id, added=[tag.name])
+
+
+@event.listens_for(Project.tags, 'remove')
+def on_tag_removed(project, tag, initiator):
+    if project.id is not None:
+        related_index.update(project.id, removed=[tag.name])
+
+
+@event.listens_for(Project, 'after_delete')
+def on_project_deleted(mapper, connection, project):
+    related_index.remove(project.id)
@@ -0,0 +1,70 @@
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+
+from app.store import shared_store
+
+import random
+import time
+
+
+READ_METHODS = {'GET', 'HEAD'}
+
+
+class RoutingSession(Session):
+    """
+    Session that sends reads to a replica when the current request picked one
+    (see route_request), and everything else to the primary database.
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not getattr(clause, 'is_dml', False):
+            replica = g.get('replica') if has_request_context() else None
+            if replica is not None:
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class RecentWriters(object):
+    """
+    Users who wrote something in the last REPLICA_STICKY_SECONDS, whose reads stay on the
+    primary until the replicas have caught up (read-after-write). Kept in the shared store,
+    since the user's next request may well go to another worker.
+    """
+
+    # Seconds between sweeps of expired rows
+    cleanup_interval = 60
+
+    def __init__(self, store):
+        self.store = store
+        self.cleaned_at = time.time()
+
+    def add(self, user_id, seconds):
+        now = time.time()
+        with self.store.statements() as connection:
+            if now - self.cleaned_at > self.cleanup_interval:
+                connection.execute('DELETE FROM recent_writer WHERE until < ?', (now,))
+                self.cleaned_at = now
+            connection.execute('INSERT OR REPLACE INTO recent_writer VALUES (?, ?)', (user_id, now + seconds))
+
+    def __contains__(self, user_id):
+        with self.store.statements() as connection:
+            row = connection.execute('SELECT until FROM recent_writer WHERE user_id = ?', (user_id,)).fetchone()
+        return row is not None and row[0] > time.time()
+
+
+recent_writers = RecentWriters(shared_store)
+
+
+def route_request(app, method, user_id):
+    """
+    Pick a replica for this request if it only reads and its user hasn't written recently.
+    """
+    binds = app.config['REPLICA_BINDS']
+    if binds and method in READ_METHODS and user_id not in recent_writers:
+        g.replica = random.choice(binds)
+
+
+def record_write(app, method, user_id):
+    if app.config['REPLICA_BINDS'] and method not in READ_METHODS:
+        recent_writers.add(user_id, app.config['REPLICA_STICKY_SECONDS'])
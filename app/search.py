@@ -0,0 +1,182 @@
+from sqlalchemy import event, inspect, text
+
+from app import db
+from app.models import Project
+
+import re
+
+
+# Full-text project search.
+#
+# Every project has one row in project_search holding its name, description and tag
+# names. On Postgres that row is a weighted tsvector with a GIN index; on SQLite it is
+# the content table behind an FTS5 index. The row is rewritten whenever a project is
+# flushed, so the index stays in step with the project table inside the same transaction.
+
+POSTGRES_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS project_search (
+        project_id VARCHAR PRIMARY KEY REFERENCES project (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS ix_project_search_document ON project_search USING GIN (document)',
+)
+
+SQLITE_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS project_search (
+        id INTEGER PRIMARY KEY,
+        project_id VARCHAR NOT NULL UNIQUE,
+        name VARCHAR,
+        description VARCHAR,
+        tags VARCHAR
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS project_fts USING fts5(
+        name, description, tags, content='project_search', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS project_search_ai AFTER INSERT ON project_search BEGIN
+        INSERT INTO project_fts (rowid, name, description, tags)
+        VALUES (new.id, new.name, new.description, new.tags);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS project_search_ad AFTER DELETE ON project_search BEGIN
+        INSERT INTO project_fts (project_fts, rowid, name, description, tags)
+        VALUES ('delete', old.id, old.name, old.description, old.tags);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS project_search_au AFTER UPDATE ON project_search BEGIN
+        INSERT INTO project_fts (project_fts, rowid, name, description, tags)
+        VALUES ('delete', old.id, old.name, old.description, old.tags);
+        INSERT INTO project_fts (rowid, name, description, tags)
+        VALUES (new.id, new.name, new.description, new.tags);
+    END
+    """,
+)
+
+# Project attributes that make up the search document
+INDEXED_ATTRS = ('name', 'description', 'tags')
+
+POSTGRES_UPSERT = text("""
+    INSERT INTO project_search (project_id, document)
+    VALUES (:project_id,
+            setweight(to_tsvector('english', coalesce(:name, '')), 'A')
+            || setweight(to_tsvector('english', coalesce(:description, '')), 'B')
+            || setweight(to_tsvector('english', :tags), 'C'))
+    ON CONFLICT (project_id) DO UPDATE SET document = excluded.document
+""")
+
+SQLITE_UPSERT = text("""
+    INSERT INTO project_search (project_id, name, description, tags)
+    VALUES (:project_id, :name, :description, :tags)
+    ON CONFLICT (project_id) DO UPDATE
+    SET name = excluded.name, description = excluded.description, tags = excluded.tags
+""")
+
+POSTGRES_SEARCH = text("""
+    SELECT project_id FROM project_search, to_tsquery('english', :query) query
+    WHERE document @@ query
+    ORDER BY ts_rank(document, query) DESC, project_id
+    LIMIT :limit OFFSET :offset
+""")
+
+SQLITE_SEARCH = text("""
+    SELECT project_search.project_id FROM project_fts
+    JOIN project_search ON project_search.id = project_fts.rowid
+    WHERE project_fts MATCH :query
+    ORDER BY bm25(project_fts, 10.0, 5.0, 2.0), project_search.project_id
+    LIMIT :limit OFFSET :offset
+""")
+
+
+def create_index(connection):
+    """
+    Create the search tables for this backend if they don't exist yet.
+    """
+    ddl = {'postgresql': POSTGRES_DDL, 'sqlite': SQLITE_DDL}.get(connection.dialect.name, ())
+    for statement in ddl:
+        connection.execute(text(statement))
+
+
+@event.listens_for(db.metadata, 'after_create')
+def on_create_all(target, connection, **kwargs):
+    create_index(connection)
+
+
+def index_rows(connection, rows):
+    """
+    Write search documents given as dicts of project_id, name, description and tags
+    (space-separated tag names).
+    """
+    upsert = {'postgresql': POSTGRES_UPSERT, 'sqlite': SQLITE_UPSERT}.get(connection.dialect.name)
+    if upsert is None or not rows:
+        return
+    connection.execute(upsert, rows)
+
+
+def index_projects(connection, projects):
+    index_rows(connection, [
+        {
+            'project_id': project.id,
+            'name': project.name,
+            'description': project.description,
+            'tags': ' '.join(tag.name for tag in project.tags),
+        }
+        for project in projects
+    ])
+
+
+def unindex_projects(connection, project_ids):
+    if connection.dialect.name not in ('postgresql', 'sqlite') or not project_ids:
+        return
+    connection.execute(text('DELETE FROM project_search WHERE project_id = :project_id'),
+                       [{'project_id': project_id} for project_id in project_ids])
+
+
+def needs_reindex(project):
+    attrs = inspect(project).attrs
+    return any(attrs[key].history.has_changes() for key in INDEXED_ATTRS)
+
+
+@event.listens_for(db.session, 'after_flush')
+def sync_index(session, flush_context):
+    changed = [obj for obj in session.new if isinstance(obj, Project)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Project) and needs_reindex(obj)]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Project)]
+    if changed or deleted:
+        connection = session.connection()
+        index_projects(connection, changed)
+        unindex_projects(connection, deleted)
+
+
+def search_project_ids(query, limit, offset=0):
+    """
+    Find projects matching every word of query (as a prefix), best matches first.
+    :return: list of project ids
+    """
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return []
+    dialect = db.session.get_bind().dialect.name
+    params = {'limit': limit, 'offset': offset}
+    if dialect == 'postgresql':
+        statement = POSTGRES_SEARCH
+        params['query'] = ' & '.join(word + ':*' for word in words)
+    elif dialect == 'sqlite':
+        statement = SQLITE_SEARCH
+        params['query'] = ' '.join('"%s"*' % word for word in words)
+    else:
+        # No native index on this backend; fall back to a scan over name and description
+        matches = Project.query
+        for word in words:
+            pattern = '%' + word + '%'
+            matches = matches.filter(Project.name.ilike(pattern) | Project.description.ilike(pattern))
+        projects = matches.order_by(Project.id).limit(limit).offset(offset)
+        return [project.id for project in projects]
+    return [row.project_id for row in db.session.execute(statement, params)]
@@ -0,0 +1,168 @@
+from app import db
+from app.models import User, Project, Tag, Review, CollectionVersion, taggings
+from app.passwords import password_hasher
+from app.search import index_rows
+from app.util import get_now, insert_or_ignore, bulk_insert
+
+import random
+import time
+import uuid
+
+
+# Bulk generation of realistic-looking data, for benchmarks and for reproducing production
+# scale locally. Rows go straight into the tables through Core (COPY on Postgres), every
+# user shares one precomputed password hash, and ids are derived from a per-run prefix and
+# the row number so nothing has to be looked up or kept in memory between batches.
+
+WORDS = (
+    'python', 'flask', 'react', 'rust', 'go', 'java', 'swift', 'kotlin', 'node', 'django',
+    'vue', 'svelte', 'postgres', 'redis', 'docker', 'kubernetes', 'ml', 'ai', 'data', 'web',
+    'mobile', 'game', 'cli', 'api', 'graphql', 'security', 'crypto', 'iot', 'robotics', 'audio',
+    'video', 'maps', 'chat', 'health', 'finance', 'education', 'music', 'social', 'devops', 'testing',
+)
+ADJECTIVES = ('Tiny', 'Open', 'Smart', 'Fast', 'Simple', 'Shared', 'Green', 'Bright', 'Quiet', 'Daily')
+NOUNS = ('Tracker', 'Planner', 'Bot', 'Dashboard', 'Notes', 'Finder', 'Studio', 'Lab', 'Hub', 'Engine')
+FIRST_NAMES = ('Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley', 'Jamie', 'Avery', 'Quinn')
+LAST_NAMES = ('Smith', 'Chen', 'Garcia', 'Patel', 'Kim', 'Nguyen', 'Brown', 'Okafor', 'Silva', 'Novak')
+
+# Data covers the past year
+TIME_SPAN = 365 * 24 * 3600
+# Shape of the skewed choices: index = n * random() ** SKEW, so low indices are far more likely
+SKEW = 3
+# Tail of the likes-per-project distribution (Pareto; lower is heavier)
+LIKES_ALPHA = 1.2
+
+
+class Dataset(object):
+    """
+    Generates users, projects, tags, taggings and likes.
+
+    Projects are owned mostly by a few prolific users, tag use and like counts are heavily
+    skewed (a few very popular tags and projects, a long tail of quiet ones), and like_count
+    and trending_score are written consistently with the generated reviews.
+    """
+
+    def __init__(self, users, projects, tags, likes_per_project, seed=None):
+        self.users = users
+        self.projects = projects
+        self.rng = random.Random(seed)
+        # Ids look like uuid4s: a random prefix per run plus the row number
+        self.prefix = str(uuid.UUID(int=self.rng.getrandbits(128), version=4))[:24]
+        self.tag_names = self.make_tag_names(tags)
+        # Mean of paretovariate(alpha) - 1 is 1 / (alpha - 1)
+        self.likes_scale = likes_per_project * (LIKES_ALPHA - 1)
+        self.now = get_now()
+        self.counts = dict.fromkeys(('user', 'project', 'tag', 'tagging', 'review'), 0)
+
+    def make_tag_names(self, count):
+        names = list(WORDS[:count])
+        for first in WORDS:
+            for second in WORDS:
+                if len(names) >= count:
+                    return names
+                if first != second:
+                    names.append(first + '-' + second)
+        return names
+
+    def skewed(self, n):
+        return int(n * self.rng.random() ** SKEW)
+
+    def user_id(self, i):
+        return '%s%012x' % (self.prefix, i)
+
+    def project_id(self, i):
+        return '%s%012x' % (self.prefix, (1 << 47) | i)
+
+    def email(self, i):
+        return 'user%d.%s@example.com' % (i, self.prefix[:8])
+
+    def user_rows(self, start, stop, password):
+        rng = self.rng
+        for i in range(start, stop):
+            first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            registered_at = self.now - rng.randrange(TIME_SPAN)
+            yield {
+                'id': self.user_id(i),
+                'username': '%s%s%d' % (first_name.lower(), last_name[0].lower(), i),
+                'email': self.email(i),
+                'first_name': first_name,
+                'last_name': last_name,
+                'admin': False,
+                'password': password,
+                'confirmed': True,
+                'registered_at': registered_at,
+                'last_seen': registered_at + rng.randrange(self.now - registered_at + 1),
+                'version': 1,
+            }
+
+    def project_rows(self, start, stop):
+        """
+        :return: lists of project, tagging, review and search index rows for projects start..stop
+        """
+        rng = self.rng
+        projects, tagged, reviews, documents = [], [], [], []
+        for i in range(start, stop):
+            project_id = self.project_id(i)
+            created_at = self.now - rng.randrange(TIME_SPAN)
+            tags = sorted({self.tag_names[self.skewed(len(self.tag_names))] for _ in range(rng.randint(1, 5))})
+            name = '%s %s %s' % (rng.choice(ADJECTIVES), tags[0].split('-')[0].capitalize(), rng.choice(NOUNS))
+            description = 'A %s project about %s.' % (tags[0], ', '.join(tags[1:]) or tags[0])
+
+            likes = min(self.users, int((rng.paretovariate(LIKES_ALPHA) - 1) * self.likes_scale))
+            trending_score = 0.0
+            for user in rng.sample(range(self.users), likes):
+                liked_at = created_at + rng.randrange(self.now - created_at + 1)
+                trending_score += Project.trending_weight(liked_at)
+                reviews.append({'user_id': self.user_id(user), 'project_id': project_id, 'created_at': liked_at})
+
+            projects.append({
+                'id': project_id,
+                'name': name,
+                'description': description,
+                'image_url': None,
+                'github_url': 'https://github.com/example/project-%d' % i,
+                'like_count': likes,
+                'trending_score': trending_score,
+                'created_at': created_at,
+                'updated_at': created_at,
+                'version': 1,
+                'user_id': self.user_id(self.skewed(self.users)),
+            })
+            tagged += [{'project_id': project_id, 'tag_name': tag} for tag in tags]
+            documents.append({'project_id': project_id, 'name': name, 'description': description,
+                              'tags': ' '.join(tags)})
+        return projects, tagged, reviews, documents
+
+    def generate(self, batch_size, password='password'):
+        """
+        Insert the whole dataset, committing every batch_size users or projects.
+        :return: seconds taken
+        """
+        started = time.perf_counter()
+        session = db.session
+        self.counts['tag'] = insert_or_ignore(session, Tag.__table__, [{'name': name} for name in self.tag_names])
+        password = password_hasher.hash(password)
+
+        for start in range(0, self.users, batch_size):
+            rows = list(self.user_rows(start, min(start + batch_size, self.users), password))
+            bulk_insert(session.connection(), User.__table__, rows)
+            self.counts['user'] += len(rows)
+            session.commit()
+
+        for start in range(0, self.projects if self.users else 0, batch_size):
+            projects, tagged, reviews, documents = self.project_rows(start, min(start + batch_size, self.projects))
+            connection = session.connection()
+            bulk_insert(connection, Project.__table__, projects)
+            bulk_insert(connection, taggings, tagged)
+            bulk_insert(connection, Review.__table__, reviews)
+            index_rows(connection, documents)
+            self.counts['project'] += len(projects)
+            self.counts['tagging'] += len(tagged)
+            self.counts['review'] += len(reviews)
+            session.commit()
+
+        # Listings cached by clients are now stale
+        CollectionVersion.bump(session, 'users')
+        CollectionVersion.bump(session, 'projects')
+        session.commit()
+        return time.perf_counter() - started
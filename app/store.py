@@ -0,0 +1,80 @@
+from config import Config
+
+import contextlib
+import os
+import sqlite3
+import threading
+
+
+# State every worker process has to agree on: rate limit buckets, bcrypt slots, and
+# so on. It's kept in a small SQLite database; under gunicorn all workers open the same
+# file (gunicorn.conf.py sets SHARED_STORE), so it holds for the whole server. Without it
+# (flask run, scripts) each process has its own database in memory.
+
+SCHEMA = (
+    # Token buckets of app/ratelimit.py
+    'CREATE TABLE IF NOT EXISTS bucket '
+    '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL) WITHOUT ROWID',
+    # Password hashes running or waiting to run, see app/passwords.py
+    'CREATE TABLE IF NOT EXISTS hash_slot '
+    '(token TEXT PRIMARY KEY, running INTEGER NOT NULL, updated REAL NOT NULL) WITHOUT ROWID',
+    # Users whose reads stay on the primary until a time, see app/routing.py
+    'CREATE TABLE IF NOT EXISTS recent_writer (user_id TEXT PRIMARY KEY, until REAL NOT NULL) WITHOUT ROWID',
+    # When users' cached auth principals went stale, see app/principals.py
+    'CREATE TABLE IF NOT EXISTS revoked_principal (user_id TEXT PRIMARY KEY, revoked_at REAL NOT NULL) WITHOUT ROWID',
+)
+
+
+class SharedStore(object):
+    """
+    Connection to the shared SQLite database at path (in memory if None), one per process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # A connection inherited through fork can't be used
+        if self.connection is None or self.pid != os.getpid():
+            connection = sqlite3.connect(self.path or ':memory:', timeout=5, isolation_level=None,
+                                         check_same_thread=False)
+            if self.path:
+                connection.execute('PRAGMA journal_mode=WAL')
+            # Losing the last moments of state to a crash is harmless; waiting on fsync isn't
+            connection.execute('PRAGMA synchronous=OFF')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self.connection = connection
+            self.pid = os.getpid()
+        return self.connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the block's statements in one write transaction, serialized with all processes.
+        Yields the connection.
+        """
+        with self.lock:
+            connection = self.connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    @contextlib.contextmanager
+    def statements(self):
+        """
+        Yields the connection for statements that each commit on their own.
+        """
+        with self.lock:
+            yield self.connect()
+
+
+# From Config rather than app.config: app.routing needs this before the app exists
+shared_store = SharedStore(Config.SHARED_STORE)
@@ -0,0 +1,245 @@
+from sqlalchemy import event, select
+
+from app import app, db
+from app.cache import RebuiltIndex
+from app.models import Project, taggings
+
+from array import array
+import bisect
+import time
+import uuid
+
+
+# Tag filtering and facet counts from per-tag bitmaps.
+#
+# Every project gets a dense ordinal, given out in listing order (created_at, id), and
+# every tag a bitmap of the ordinals of its projects, held in a Python int. Filtering by
+# several tags is then a handful of big-int ANDs or ORs, a tag's count is a popcount, and
+# since ordinals follow the listing order, a page of matches is the next set bits after
+# the cursor's position.
+
+
+def to_bitmap(ordinals, size):
+    """
+    :return: int with the bits of ordinals set, built in one pass rather than bit by bit
+    """
+    buffer = bytearray((size + 7) // 8)
+    for ordinal in ordinals:
+        buffer[ordinal >> 3] |= 1 << (ordinal & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def set_bits(bitmap, start, limit):
+    """
+    :return: up to limit positions of set bits of bitmap, counting from start, lowest first
+    """
+    positions = []
+    bitmap >>= start
+    while bitmap and len(positions) < limit:
+        lowest = bitmap & -bitmap
+        position = lowest.bit_length() - 1
+        positions.append(start + position)
+        bitmap >>= position + 1
+        start += position + 1
+    return positions
+
+
+class TagBitmaps(RebuiltIndex):
+    """
+    In-memory bitmap index of which projects carry which tags.
+
+    Like tag_index it's built from the database on first use and updated straight away by
+    Project.tags changes in this process. It's rebuilt every TAG_BITMAP_TTL seconds on a
+    background thread to pick up other workers' changes (and projects created here out of
+    listing order), while requests keep using the previous one.
+    """
+
+    name = 'tag bitmaps'
+
+    def __init__(self):
+        super().__init__()
+        # Listing keys by ordinal, sorted: created_at alongside id
+        self.created = array('q')
+        self.ids = []
+        self.ordinals = {}
+        self.bitmaps = {}
+        self.ranked_counts = None
+        # Which build this is and how many changes it has had since, for ETags
+        self.build_id = None
+        self.changes = 0
+
+    def build(self):
+        created = array('q')
+        ids = []
+        rows = db.session.execute(
+            select(Project.created_at, Project.id).order_by(Project.created_at, Project.id)
+            .execution_options(yield_per=10000))
+        for created_at, project_id in rows:
+            created.append(created_at or 0)
+            ids.append(project_id)
+        ordinals = {project_id: ordinal for ordinal, project_id in enumerate(ids)}
+        tagged = {}
+        for project_id, tag_name in db.session.execute(select(taggings.c.project_id, taggings.c.tag_name)):
+            ordinal = ordinals.get(project_id)
+            if ordinal is not None:
+                tagged.setdefault(tag_name, []).append(ordinal)
+        bitmaps = {name: to_bitmap(tag_ordinals, len(ids)) for name, tag_ordinals in tagged.items()}
+        with self.lock:
+            self.created = created
+            self.ids = ids
+            self.ordinals = ordinals
+            self.bitmaps = bitmaps
+            self.ranked_counts = None
+            self.build_id = uuid.uuid4().hex[:12]
+            self.changes = 0
+            self.built_at = time.monotonic()
+
+    def ttl(self):
+        return app.config['TAG_BITMAP_TTL']
+
+    def ordinal(self, project):
+        """
+        :return: project's ordinal, given out now if it's new and sorts after every other
+            project; None if it can't be placed until the next rebuild
+        """
+        ordinal = self.ordinals.get(project.id)
+        if ordinal is not None or project.created_at is None:
+            return ordinal
+        if self.ids and (project.created_at, project.id) <= (self.created[-1], self.ids[-1]):
+            return None
+        ordinal = len(self.ids)
+        self.created.append(project.created_at)
+        self.ids.append(project.id)
+        self.ordinals[project.id] = ordinal
+        return ordinal
+
+    def update(self, project, name, present):
+        with self.lock:
+            if self.built_at is None or project.id is None:
+                return
+            ordinal = self.ordinal(project)
+            if ordinal is None:
+                # Force the next request to rebuild
+                self.built_at = 0
+                return
+            bitmap = self.bitmaps.get(name, 0)
+            if present:
+                bitmap |= 1 << ordinal
+            else:
+                bitmap &= ~(1 << ordinal)
+            if bitmap:
+                self.bitmaps[name] = bitmap
+            else:
+                self.bitmaps.pop(name, None)
+            self.ranked_counts = None
+            self.changes += 1
+
+    def remove(self, project_id):
+        with self.lock:
+            ordinal = self.ordinals.get(project_id)
+            if ordinal is None:
+                return
+            mask = 1 << ordinal
+            for name, bitmap in list(self.bitmaps.items()):
+                if bitmap & mask:
+                    if bitmap == mask:
+                        del self.bitmaps[name]
+                    else:
+                        self.bitmaps[name] = bitmap ^ mask
+            self.ranked_counts = None
+            self.changes += 1
+
+    def etag(self):
+        """
+        The bitmaps lag behind the database by up to TAG_BITMAP_TTL seconds (changes made by
+        other workers), so responses built from them can't be tagged with the collection
+        version alone: a client would keep getting 304s for a stale list.
+        :return: token that changes whenever the bitmaps of this worker do
+        """
+        self.ensure_fresh()
+        with self.lock:
+            return '%s.%d' % (self.build_id, self.changes)
+
+    def matching(self, names, mode):
+        """
+        :return: bitmap of the projects with all (mode 'all') or any (mode 'any') of names
+        """
+        bitmaps = [self.bitmaps.get(name, 0) for name in names]
+        if not bitmaps:
+            return 0
+        if mode == 'any':
+            matches = 0
+            for bitmap in bitmaps:
+                matches |= bitmap
+            return matches
+        # Sparsest first, so the running intersection shrinks as fast as possible
+        bitmaps.sort(key=int.bit_count)
+        matches = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            if not matches:
+                break
+            matches &= bitmap
+        return matches
+
+    def position(self, key):
+        """
+        :return: ordinal of the first project listed after key, a (created_at, id) pair
+        """
+        created_at, project_id = key
+        created_at = created_at or 0
+        start = bisect.bisect_left(self.created, created_at)
+        end = bisect.bisect_right(self.created, created_at, start)
+        return bisect.bisect_right(self.ids, project_id, start, end)
+
+    def page(self, names, mode, after, limit):
+        """
+        One page of projects matching the tags, in listing order.
+        :param after: (created_at, id) of the last project of the previous page, or None
+        :return: (project ids, number of matching projects, key to continue after or None)
+        """
+        self.ensure_fresh()
+        with self.lock:
+            matches = self.matching(names, mode)
+            start = self.position(after) if after is not None else 0
+            ordinals = set_bits(matches, start, limit + 1)
+            project_ids = [self.ids[ordinal] for ordinal in ordinals[:limit]]
+            next_key = None
+            if len(ordinals) > limit:
+                last = ordinals[limit - 1]
+                next_key = [self.created[last], self.ids[last]]
+            return project_ids, matches.bit_count(), next_key
+
+    def counts(self, names=(), mode='all'):
+        """
+        Projects per tag, or with names, per tag among the projects matching them.
+        :return: list of (tag name, count), largest first, leaving out zero counts
+        """
+        self.ensure_fresh()
+        with self.lock:
+            if not names:
+                if self.ranked_counts is None:
+                    self.ranked_counts = sorted(((name, bitmap.bit_count()) for name, bitmap in self.bitmaps.items()),
+                                                key=lambda item: (-item[1], item[0]))
+                return self.ranked_counts
+            matches = self.matching(names, mode)
+            counts = ((name, (bitmap & matches).bit_count()) for name, bitmap in self.bitmaps.items())
+            return sorted(((name, count) for name, count in counts if count),
+                          key=lambda item: (-item[1], item[0]))
+
+
+tag_bitmaps = TagBitmaps()
+
+
+@event.listens_for(Project.tags, 'append')
+def on_tag_added(project, tag, initiator):
+    tag_bitmaps.update(project, tag.name, True)
+
+
+@event.listens_for(Project.tags, 'remove')
+def on_tag_removed(project, tag, initiator):
+    tag_bitmaps.update(project, tag.name, False)
+
+
+@event.listens_for(Project, 'after_delete')
+def on_project_deleted(mapper, connection, project):
+    tag_bitmaps.remove(project.id)
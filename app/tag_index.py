@@ -0,0 +1,153 @@
+from sqlalchemy import event, func, select
+
+from app import app, db
+from app.cache import RebuiltIndex
+from app.models import Project, Tag, taggings
+
+import bisect
+import heapq
+import itertools
+import time
+
+# Above this many matches, walk the popularity order rather than rank every match
+RANK_SCAN_THRESHOLD = 256
+# Answers to recent queries, dropped whenever the index changes
+RESULT_CACHE_SIZE = 4096
+
+
+def trigrams(name):
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+class TagIndex(RebuiltIndex):
+    """
+    In-memory index of tag names for autocomplete.
+
+    Keeps the names sorted (prefix lookups are a bisect), a trigram map for substring
+    lookups, and how many projects use each tag so matches can be ranked by popularity.
+    The index is built from the database on first use and rebuilt in the background every
+    TAG_INDEX_TTL seconds to pick up changes made by other workers; changes made in this
+    process are applied straight away through the Project.tags collection events below.
+    """
+
+    name = 'tag index'
+
+    def __init__(self):
+        super().__init__()
+        self.names = []
+        self.counts = {}
+        self.grams = {}
+        self.ranked_names = None
+        self.results = {}
+
+    def build(self):
+        counts = {name: 0 for name in db.session.execute(select(Tag.name)).scalars()}
+        rows = db.session.execute(
+            select(taggings.c.tag_name, func.count()).group_by(taggings.c.tag_name))
+        counts.update((name, count) for name, count in rows)
+        grams = {}
+        for name in counts:
+            for gram in trigrams(name):
+                grams.setdefault(gram, set()).add(name)
+        with self.lock:
+            self.names = sorted(counts)
+            self.counts = counts
+            self.grams = grams
+            self.ranked_names = None
+            self.results = {}
+            self.built_at = time.monotonic()
+
+    def ttl(self):
+        return app.config['TAG_INDEX_TTL']
+
+    def add(self, name, uses=1):
+        with self.lock:
+            if self.built_at is None:
+                return
+            if name not in self.counts:
+                bisect.insort(self.names, name)
+                self.counts[name] = 0
+                for gram in trigrams(name):
+                    self.grams.setdefault(gram, set()).add(name)
+            self.counts[name] = max(0, self.counts[name] + uses)
+            self.ranked_names = None
+            self.results = {}
+
+    def discard(self, name):
+        self.add(name, -1)
+
+    def prefix_matches(self, prefix):
+        start = bisect.bisect_left(self.names, prefix)
+        end = bisect.bisect_left(self.names, prefix + '\uffff')
+        return self.names[start:end]
+
+    def substring_matches(self, query):
+        """
+        :return: names containing query, or None if the query is too short to use trigrams.
+        """
+        if len(query) < 3:
+            return None
+        postings = sorted((self.grams.get(gram, ()) for gram in trigrams(query)), key=len)
+        candidates = postings[0]
+        for names in postings[1:]:
+            if not candidates:
+                break
+            candidates = candidates & names
+        return [name for name in candidates if query in name]
+
+    def ranked(self):
+        """
+        :return: all names, most popular first. Re-sorted lazily after counts change.
+        """
+        if self.ranked_names is None:
+            counts = self.counts
+            self.ranked_names = sorted(counts, key=lambda name: (-counts[name], name))
+        return self.ranked_names
+
+    def top(self, matches, predicate, limit):
+        """
+        The limit most popular names among matches (all names satisfying predicate).
+        Large match sets are served by walking the popularity order instead of ranking them.
+        """
+        if matches is not None and len(matches) <= RANK_SCAN_THRESHOLD:
+            counts = self.counts
+            return heapq.nsmallest(limit, matches, key=lambda name: (-counts[name], name))
+        return list(itertools.islice(filter(predicate, self.ranked()), limit))
+
+    def search(self, query, limit):
+        """
+        Find the most popular tags containing query, with tags starting with it first.
+        :return: up to limit tag names
+        """
+        self.ensure_fresh()
+        with self.lock:
+            cached = self.results.get((query, limit))
+            if cached is not None:
+                return cached
+
+            def is_infix(name):
+                return query in name and not name.startswith(query)
+
+            results = self.top(self.prefix_matches(query), lambda name: name.startswith(query), limit)
+            if len(results) < limit:
+                infixed = self.substring_matches(query)
+                if infixed is not None:
+                    infixed = [name for name in infixed if not name.startswith(query)]
+                results += self.top(infixed, is_infix, limit - len(results))
+            if len(self.results) >= RESULT_CACHE_SIZE:
+                self.results.clear()
+            self.results[(query, limit)] = results
+            return results
+
+
+tag_index = TagIndex()
+
+
+@event.listens_for(Project.tags, 'append')
+def on_tag_added(project, tag, initiator):
+    tag_index.add(tag.name)
+
+
+@event.listens_for(Project.tags, 'remove')
+def on_tag_removed(project, tag, initiator):
+    tag_index.discard(tag.name)
@@ -0,0 +1,133 @@
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+import contextlib
+import json
+import logging
+import time
+
+
+# Per-request instrumentation: number of SQL statements and time spent in the database,
+# in authentication and in serialization, sent back in a Server-Timing header and logged
+# as one JSON line per request on the 'app.timing' logger.
+#
+# Switched on with REQUEST_TIMING. When it is off none of the hooks below are installed
+# and timed() costs a single flag check.
+
+enabled = app.config['REQUEST_TIMING']
+logger = app.logger.getChild('timing')
+
+
+class RequestTiming(object):
+    __slots__ = ('started', 'queries', 'db', 'auth', 'serialize')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.auth = 0.0
+        self.serialize = 0.0
+
+
+def current():
+    """
+    :return: RequestTiming of the current request, or None if timing is off or outside a request
+    """
+    if not enabled or not has_request_context():
+        return None
+    return g.get('timing')
+
+
+class Timer(object):
+    __slots__ = ('timing', 'metric', 'started')
+
+    def __init__(self, timing, metric):
+        self.timing = timing
+        self.metric = metric
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        setattr(self.timing, self.metric, getattr(self.timing, self.metric) + time.perf_counter() - self.started)
+
+
+NOT_TIMED = contextlib.nullcontext()
+
+
+def timed(metric):
+    """
+    Context manager adding the time spent in its block to a metric ('auth' or 'serialize')
+    of the current request.
+    """
+    timing = current()
+    if timing is None:
+        return NOT_TIMED
+    return Timer(timing, metric)
+
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = connection.info['query_started'].pop()
+    timing = current()
+    if timing is not None:
+        timing.queries += 1
+        timing.db += time.perf_counter() - started
+
+
+def handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_started'):
+        after_cursor_execute(context.connection, None, None, None, None, False)
+
+
+def server_timing(timing, total):
+    return ', '.join([
+        'db;dur=%.1f;desc="%d queries"' % (timing.db * 1000, timing.queries),
+        'auth;dur=%.1f' % (timing.auth * 1000),
+        'serialize;dur=%.1f' % (timing.serialize * 1000),
+        'total;dur=%.1f' % (total * 1000),
+    ])
+
+
+def start_timing():
+    g.timing = RequestTiming()
+
+
+def finish_timing(response):
+    timing = g.pop('timing', None)
+    if timing is None:
+        return response
+    # Streamed responses are still being generated; their remaining queries aren't counted
+    total = time.perf_counter() - timing.started
+    response.headers['Server-Timing'] = server_timing(timing, total)
+    user = g.get('user')
+    logger.info(json.dumps({
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'user': user.id if user is not None else None,
+        'queries': timing.queries,
+        'db_ms': round(timing.db * 1000, 2),
+        'auth_ms': round(timing.auth * 1000, 2),
+        'serialize_ms': round(timing.serialize * 1000, 2),
+        'total_ms': round(total * 1000, 2),
+    }))
+    return response
+
+
+if enabled:
+    logger.setLevel(logging.INFO)
+    # On the Engine class, so the primary and any replicas are all covered
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Engine, 'handle_error', handle_error)
+    app.before_request(start_timing)
+    app.after_request(finish_timing)
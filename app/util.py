@@ -1,8 +1,26 @@
-from flask import jsonify, Response
+from flask import jsonify, Response, request, current_app, stream_with_context
+from sqlalchemy import tuple_, inspect, event, insert, Date
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import DeclarativeMeta
+from sqlalchemy.orm import ColumnProperty, RelationshipProperty, load_only, noload
 
+from app.timing import timed
+
+import base64
+import binascii
+import csv
+import contextlib
 import datetime
+import io
+import itertools
 import json
+import operator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 DATE_FMT = '%Y-%m-%d'
@@ -41,12 +59,277 @@ class ModelEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def to_json(model):
-    return Response(json.dumps(model, cls=ModelEncoder), mimetype='application/json')
+# Serializers compiled once per model class, keyed by class
+SERIALIZERS = {}
+# Serializers of sparse fieldsets (?fields=), keyed by (class, fields)
+SPARSE_SERIALIZERS = {}
+
+
+def _field_getter(model, field):
+    """
+    Build a getter for one __serializable__ field that gives the same value ModelEncoder would.
+    """
+    prop = inspect(model).attrs.get(field)
+    if isinstance(prop, ColumnProperty):
+        get = operator.attrgetter(field)
+        if isinstance(prop.columns[0].type, Date):
+            return lambda obj: get(obj) and get(obj).strftime(DATE_FMT)
+        return get
+    if isinstance(prop, RelationshipProperty):
+        get = operator.attrgetter(field)
+        if field in getattr(model, '_to_expand', ()):
+            # Related models get serialized in turn by the JSON backend
+            return get
+        if prop.uselist:
+            # ModelEncoder only hides non-empty lists
+            return lambda obj: None if get(obj) else []
+        return lambda obj: None
+    # Plain attributes and properties keep the reflective behavior
+    encoder = ModelEncoder()
+
+    def get(obj):
+        val = getattr(obj, field)
+        if isinstance(val.__class__, DeclarativeMeta) or (isinstance(val, list) and len(val) > 0 and isinstance(val[0].__class__, DeclarativeMeta)):
+            if field not in model._to_expand:
+                return None
+        return encoder.val_to_string(val)
+    return get
+
+
+def compile_serializer(model, only=None):
+    """
+    Build and register a function turning instances of model into plain dicts.
+    Produces exactly what ModelEncoder.default would, without per-object reflection.
+    :param only: optional subset of serializable_fields(model) to produce, for ?fields=
+    """
+    fields = tuple(field for field in model.__serializable__ if only is None or field in only)
+    getters = tuple(_field_getter(model, field) for field in fields)
+    extra_props = getattr(model, 'extra_props', None)
+    extra_fields = set(getattr(model, '__extra_props__', ())) & set(only or ())
+
+    if extra_props and only is None:
+        def serialize(obj):
+            data = {field: get(obj) for field, get in zip(fields, getters)}
+            data.update(obj.extra_props())
+            return data
+    elif extra_fields:
+        def serialize(obj):
+            data = {field: get(obj) for field, get in zip(fields, getters)}
+            data.update((field, value) for field, value in obj.extra_props().items() if field in extra_fields)
+            return data
+    else:
+        def serialize(obj):
+            return {field: get(obj) for field, get in zip(fields, getters)}
+
+    if only is None:
+        SERIALIZERS[model] = serialize
+    else:
+        SPARSE_SERIALIZERS[(model, only)] = serialize
+    return serialize
+
+
+_fallback_encoder = ModelEncoder()
+
+
+def _default(obj):
+    serialize = SERIALIZERS.get(obj.__class__)
+    if serialize is not None:
+        return serialize(obj)
+    return _fallback_encoder.default(obj)
+
+
+def _sparse_default(only):
+    """
+    :param only: (model, fields) pair: instances of model get just those fields
+    """
+    if only is None or only[1] == serializable_fields(only[0]):
+        return _default
+    model = only[0]
+    serialize = SPARSE_SERIALIZERS.get(only) or compile_serializer(*only)
+
+    def default(obj):
+        if obj.__class__ is model:
+            return serialize(obj)
+        return _default(obj)
+    return default
+
+
+def dumps(model, only=None) -> bytes:
+    """
+    Serialize models (or structures containing them) to JSON bytes, using orjson if installed.
+    :param only: optional (model class, fields) to serialize instances of that class sparsely
+    """
+    default = _sparse_default(only)
+    if orjson is not None:
+        return orjson.dumps(model, default=default)
+    return json.dumps(model, default=default).encode()
+
+
+def to_json(model, only=None):
+    with timed('serialize'):
+        body = dumps(model, only)
+    return Response(body, mimetype='application/json')
+
+
+def to_json_stream(query, only=None):
+    """
+    Stream a query's results as a JSON array.
+    Rows are fetched STREAM_CHUNK_SIZE at a time through a server-side cursor and each chunk
+    is serialized and sent before the next is loaded, so memory use doesn't grow with the
+    number of rows and the first bytes go out as soon as the first chunk is ready.
+    """
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+
+    def generate():
+        try:
+            rows = iter(query.yield_per(chunk_size))
+            separator = b'['
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                with timed('serialize'):
+                    body = b','.join(dumps(row, only) for row in chunk)
+                yield separator + body
+                separator = b','
+            yield b'[]' if separator == b'[' else b']'
+        finally:
+            # The request's session was already removed at teardown when this runs;
+            # the query's session reopened a connection that nothing else will return
+            query.session.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+# Sparse fieldsets
+
+def serializable_fields(model):
+    """
+    :return: every field a client may ask for: __serializable__, then the extra_props keys
+    """
+    return tuple(model.__serializable__) + tuple(getattr(model, '__extra_props__', ()))
+
+
+def requested_fields(model):
+    """
+    Fields of model asked for with ?fields=a,b, in their usual order.
+    :return: tuple of field names (all of them without ?fields=), or None if one isn't serializable
+    """
+    allowed = serializable_fields(model)
+    fields = request.args.get('fields')
+    if fields is None:
+        return allowed
+    names = {name.strip() for name in fields.split(',') if name.strip()}
+    if not names or not names <= set(allowed):
+        return None
+    return tuple(field for field in allowed if field in names)
+
+
+def field_options(model, fields, loaders, *keys):
+    """
+    Loader options fetching only what's needed to serialize fields of model: load_only its
+    columns (and keys, e.g. for pagination), noload relationships that weren't asked for.
+    :param loaders: the usual loader option of each relationship field, used when it is asked for
+    :return: list of options; with all fields, just the loaders
+    """
+    if fields == serializable_fields(model):
+        return list(loaders.values())
+    mapper = inspect(model)
+    columns = [getattr(model, field) for field in fields if isinstance(mapper.attrs.get(field), ColumnProperty)]
+    options = [load_only(*columns, *keys)] if columns or keys else []
+    for field, loader in loaders.items():
+        options.append(loader if field in fields else noload(getattr(model, field)))
+    return options
+
+
+# Keyset pagination
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode an opaque pagination cursor.
+    :return: list of key values, or None if the cursor is malformed.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def is_key_value(value):
+    """
+    :return: whether a decoded cursor value can be a pagination key (a string or integer)
+    """
+    # Not null: key columns are NOT NULL, and a comparison with NULL would end the listing
+    return isinstance(value, str) or (isinstance(value, int) and not isinstance(value, bool))
+
+
+def page_limit():
+    """
+    Page size requested with ?limit=, clamped to API_MAX_PAGE_SIZE.
+    :return: the limit, or None if it isn't an integer.
+    """
+    try:
+        limit = int(request.args.get('limit', current_app.config['API_PAGE_SIZE']))
+    except ValueError:
+        return None
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+def paginate(query, *keys, only=None):
+    """
+    Serve one page of a query using keyset pagination.
+
+    Rows are ordered by the given key columns (which together must be unique), and the
+    next page starts strictly after the last row returned, so every page is a single
+    range scan over the matching index no matter how deep the client has paged.
+    The cursor for the next page is returned in the X-Next-Cursor header, and the total
+    row count in X-Total-Count only when the client passes ?count=true.
+    :param only: optional (model class, fields) to serialize sparsely, as for to_json
+    """
+    limit = page_limit()
+    if limit is None:
+        return fail('Limit must be an integer.')
+
+    page = query.order_by(*keys)
+    cursor = request.args.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor)
+        if values is None or len(values) != len(keys) or not all(is_key_value(value) for value in values):
+            return fail('Invalid cursor.')
+        page = page.filter(tuple_(*keys) > tuple_(*values))
+    items = page.limit(limit + 1).all()
+
+    response = to_json(items[:limit], only)
+    if len(items) > limit:
+        last = items[limit - 1]
+        response.headers['X-Next-Cursor'] = encode_cursor([getattr(last, key.key) for key in keys])
+    if request.args.get('count', '').lower() in ('1', 'true'):
+        response.headers['X-Total-Count'] = str(query.order_by(None).count())
+    return response
 
 
 # HTTP response generators
 
+def conditional(etag, render):
+    """
+    Answer a conditional GET: if the client already has etag, reply 304 without calling
+    render; otherwise return render()'s response tagged with etag.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = current_app.make_response(render())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    return response
+
+
 def succ(message, code=200):
     return (
         jsonify({
@@ -67,5 +350,72 @@ def fail(message, code=400):
     )
 
 
+# Bulk writes
+
+def insert_or_ignore(session, table, rows):
+    """
+    Insert rows into table, skipping any that would violate a unique constraint.
+    Uses a single INSERT ... ON CONFLICT DO NOTHING where the backend supports it.
+    :return: number of rows actually inserted
+    """
+    if not rows:
+        return 0
+    dialect = session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        return session.execute(dialect_insert(table).on_conflict_do_nothing(), rows).rowcount
+    inserted = 0
+    for row in rows:
+        try:
+            with session.begin_nested():
+                session.execute(insert(table), row)
+            inserted += 1
+        except IntegrityError:
+            pass
+    return inserted
+
+
+def bulk_insert(connection, table, rows):
+    """
+    Insert a batch of rows (dicts with the same keys) into table.
+    Streams them through COPY on Postgres with psycopg2, otherwise uses one executemany.
+    """
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql' and connection.dialect.driver == 'psycopg2':
+        columns = list(rows[0])
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([row[column] for column in columns] for row in rows)
+        buffer.seek(0)
+        preparer = connection.dialect.identifier_preparer
+        statement = 'COPY %s (%s) FROM STDIN WITH CSV' % (
+            preparer.format_table(table), ', '.join(preparer.quote(column) for column in columns))
+        connection.connection.cursor().copy_expert(statement, buffer)
+    else:
+        connection.execute(table.insert(), rows)
+
+
+@contextlib.contextmanager
+def count_queries(engine):
+    """
+    Record the SQL statements executed on engine inside the block.
+    Yields a list that the statements are appended to, e.g.:
+        with count_queries(db.engine) as queries:
+            client.get('/api/projects')
+        assert len(queries) == 4
+    """
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
 def get_now():
     return int(datetime.datetime.utcnow().timestamp())
@@ -0,0 +1,74 @@
+"""
+Check that listing endpoints run a fixed number of SQL queries regardless of how many
+rows they return (i.e. no N+1 lazy loads).
+
+Usage: python bench/query_counts.py
+Runs against a throwaway SQLite database.
+"""
+import os
+import sys
+import tempfile
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'query_counts.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app, db
+from app.models import User, Project
+from app.util import count_queries, get_now
+
+ENDPOINTS = (
+    '/api/projects?limit=200',
+    '/api/projects/search/project',
+    '/api/users/{user_id}/projects?limit=200',
+    '/api/users?limit=200',
+)
+
+
+def add_projects(user, count):
+    for _ in range(count):
+        project = Project(id=os.urandom(8).hex(), name='project', user_id=user.id, created_at=get_now())
+        db.session.add(project)
+        for tag_name in ('python', 'flask', os.urandom(2).hex()):
+            project.add_tag(tag_name)
+        db.session.commit()
+    for _ in range(count):
+        db.session.add(User(os.urandom(4).hex(), os.urandom(4).hex(), 'First', 'Last', 'password'))
+    db.session.commit()
+
+
+def measure(client, headers, user_id):
+    counts = {}
+    for endpoint in ENDPOINTS:
+        url = endpoint.format(user_id=user_id)
+        # Warm per-worker caches so only steady-state queries are counted
+        client.get(url, headers=headers)
+        db.session.remove()
+        with count_queries(db.engine) as queries:
+            response = client.get(url, headers=headers)
+        assert response.status_code == 200, (url, response.status_code)
+        counts[endpoint] = len(queries)
+    return counts
+
+
+if __name__ == '__main__':
+    app.config['BCRYPT_LOG_ROUNDS'] = 4
+    with app.app_context():
+        db.create_all()
+        user = User('bench', 'bench@example.com', 'Bench', 'User', 'password')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        headers = {'Authorization': 'Bearer ' + user.generate_token()}
+        client = app.test_client()
+
+        add_projects(user, 5)
+        small = measure(client, headers, user_id)
+        add_projects(db.session.get(User, user_id), 50)
+        large = measure(client, headers, user_id)
+
+    failed = False
+    for endpoint in ENDPOINTS:
+        ok = small[endpoint] == large[endpoint]
+        failed = failed or not ok
+        print('%-45s %3d queries %s' % (endpoint, large[endpoint], 'ok' if ok else 'FAIL (was %d with fewer rows)' % small[endpoint]))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,81 @@
+"""
+Query plans and timings for the hot lookups, without and with the indexes added in
+migration f7b2c5e8a913.
+
+Usage: python bench/query_plans.py [project count]
+Runs against a throwaway SQLite database, or BENCH_DATABASE_URL if set (its tables are dropped!).
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL') or \
+    'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'query_plans.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import text
+
+from app import app, db
+
+INDEXES = (
+    'ix_user_email',
+    'ix_user_registered_at_id',
+    'ix_project_created_at_id',
+    'ix_project_user_id_created_at_id',
+    'ix_review_project_id',
+    'uq_tagging_project_id_tag_name',
+    'ix_tagging_tag_name',
+)
+
+QUERIES = (
+    ('login by email', 'SELECT * FROM "user" WHERE email = :email'),
+    ('like lookup', 'SELECT id FROM review WHERE user_id = :user_id AND project_id = :project_id'),
+    ('likes per project', 'SELECT count(*) FROM review WHERE project_id = :project_id'),
+    ('user projects page', 'SELECT id FROM project WHERE user_id = :user_id ORDER BY created_at, id LIMIT 51'),
+    ('projects page', 'SELECT id FROM project WHERE (created_at, id) > (:created_at, :project_id) ORDER BY created_at, id LIMIT 51'),
+    ('tags of project', 'SELECT tag_name FROM tagging WHERE project_id = :project_id'),
+    ('projects with tag', 'SELECT project_id FROM tagging WHERE tag_name = :tag_name'),
+)
+
+
+def seed(connection, projects):
+    users = max(3, projects // 10)
+    connection.execute(text('INSERT INTO "user" (id, email, password, registered_at, version) VALUES (:id, :email, \'x\', :ts, 1)'),
+                       [{'id': 'u%d' % i, 'email': 'user%d@example.com' % i, 'ts': i} for i in range(users)])
+    connection.execute(text('INSERT INTO tag (name) VALUES (:name)'), [{'name': 'tag%d' % i} for i in range(100)])
+    connection.execute(text('INSERT INTO project (id, name, user_id, created_at, like_count, version, trending_score) '
+                            'VALUES (:id, :id, :user_id, :ts, 0, 1, 0)'),
+                       [{'id': 'p%d' % i, 'user_id': 'u%d' % (i % users), 'ts': i} for i in range(projects)])
+    connection.execute(text('INSERT INTO tagging (project_id, tag_name) VALUES (:project_id, :tag_name)'),
+                       [{'project_id': 'p%d' % i, 'tag_name': 'tag%d' % ((i + k) % 100)} for i in range(projects) for k in (0, 7, 13)])
+    connection.execute(text('INSERT INTO review (user_id, project_id, created_at) VALUES (:user_id, :project_id, 0)'),
+                       [{'user_id': 'u%d' % ((i + k) % users), 'project_id': 'p%d' % i} for i in range(projects) for k in range(3)])
+
+
+def report(connection, label, projects):
+    explain = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN '
+    params = {'email': 'user7@example.com', 'user_id': 'u7', 'project_id': 'p%d' % (projects // 2),
+              'created_at': projects // 2, 'tag_name': 'tag7'}
+    print('== ' + label)
+    for name, query in QUERIES:
+        plan = ' | '.join(str(row[-1]) for row in connection.execute(text(explain + query), params))
+        seconds = min(timeit.repeat(lambda: connection.execute(text(query), params).fetchall(), number=20, repeat=3)) / 20
+        print('%-20s %9.3f ms  %s' % (name, seconds * 1000, plan))
+
+
+if __name__ == '__main__':
+    projects = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        with db.engine.begin() as connection:
+            seed(connection, projects)
+            for index in INDEXES:
+                connection.execute(text('DROP INDEX %s' % index))
+            report(connection, 'before', projects)
+            for table in db.metadata.tables.values():
+                for index in table.indexes:
+                    if index.name in INDEXES:
+                        index.create(connection)
+            report(connection, 'after', projects)
@@ -0,0 +1,41 @@
+"""
+Micro-benchmark: MinHash band keys with NumPy vs. pure Python.
+
+Usage: python bench/related.py [project count]
+"""
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import related
+
+
+def build_tag_lists(count):
+    rng = random.Random(0)
+    names = ['tag%d' % i for i in range(200)]
+    return [sorted(set(rng.sample(names, rng.randint(1, 5)))) for _ in range(count)]
+
+
+def python_keys(tag_lists):
+    numpy, related.numpy = related.numpy, None
+    try:
+        return related.band_keys_many(tag_lists)
+    finally:
+        related.numpy = numpy
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    tag_lists = build_tag_lists(count)
+    # Both paths give the same keys, including for an empty index (no tagged projects)
+    assert related.band_keys_many([]) == python_keys([]) == []
+    assert related.band_keys_many(tag_lists) == python_keys(tag_lists)
+
+    python = min(timeit.repeat(lambda: python_keys(tag_lists), number=1, repeat=3))
+    vectorized = min(timeit.repeat(lambda: related.band_keys_many(tag_lists), number=1, repeat=3))
+    print('%d tag sets' % count)
+    print('pure Python: %8.1f ms' % (python * 1000))
+    print('NumPy:       %8.1f ms (%.1fx)' % (vectorized * 1000, python / vectorized))
@@ -0,0 +1,233 @@
+"""
+Load test for every API and auth endpoint.
+
+Seeds a database, then drives each endpoint in turn with concurrent in-process clients
+and reports throughput, latency percentiles and SQL queries per request. Results are
+compared against bench/baseline.json: an endpoint regresses if it answers with an error
+or runs more queries per request than the baseline. With --check-latency, it also
+regresses if its p95 latency grows by more than --tolerance; latencies only compare
+between runs on the same machine, so that is opt-in.
+
+Usage:
+    python bench/run.py [--projects N] [--clients N] [--requests N] [--only NAME ...] [--check-latency]
+    python bench/run.py --save-baseline
+Runs against a throwaway SQLite database, or BENCH_DATABASE_URL if set (its tables are dropped!).
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL') or \
+    'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import event
+
+from app import app, db
+from app.models import User
+from app.seed import Dataset
+from app.feed import build_feed
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+class Context(object):
+    """
+    Seeded ids and per-client credentials that scenarios draw from.
+    """
+
+    def __init__(self, user_ids, emails, project_ids, tag_names, tokens):
+        self.user_ids = user_ids
+        self.emails = emails
+        self.project_ids = project_ids
+        self.tag_names = tag_names
+        self.tokens = tokens
+        self.counter = iter(range(10 ** 9))
+        self.lock = threading.Lock()
+
+    def unique(self):
+        with self.lock:
+            return next(self.counter)
+
+
+def project_body(ctx):
+    return {'name': 'Bench project', 'description': 'Made by the load test',
+            'tags': random.sample(ctx.tag_names, 3)}
+
+
+# name: (method, path, body, acceptable status codes, authenticated)
+SCENARIOS = {
+    'api.users': ('GET', lambda ctx: '/api/users', None, {200}, True),
+    'api.user': ('GET', lambda ctx: '/api/users/' + random.choice(ctx.user_ids), None, {200}, True),
+    'api.user_projects': ('GET', lambda ctx: '/api/users/%s/projects' % random.choice(ctx.user_ids), None, {200}, True),
+    'api.users_export': ('GET', lambda ctx: '/api/users/export', None, {200}, True),
+    'api.projects': ('GET', lambda ctx: '/api/projects', None, {200}, True),
+    'api.projects_sparse': ('GET', lambda ctx: '/api/projects?fields=id,name,like_count', None, {200}, True),
+    'api.project': ('GET', lambda ctx: '/api/projects/' + random.choice(ctx.project_ids), None, {200}, True),
+    'api.projects_export': ('GET', lambda ctx: '/api/projects/export', None, {200}, True),
+    'api.projects_trending': ('GET', lambda ctx: '/api/projects/trending', None, {200}, True),
+    'api.project_related': ('GET', lambda ctx: '/api/projects/%s/related' % random.choice(ctx.project_ids), None, {200}, True),
+    'api.feed': ('GET', lambda ctx: '/api/feed', None, {200}, True),
+    'api.projects_tagged': ('GET', lambda ctx: '/api/projects?tags=%s,%s&mode=%s' % (
+        random.choice(ctx.tag_names), random.choice(ctx.tag_names), random.choice(('all', 'any'))), None, {200}, True),
+    'api.tags': ('GET', lambda ctx: '/api/tags', None, {200}, True),
+    'api.tag_facets': ('GET', lambda ctx: '/api/tags?tags=' + random.choice(ctx.tag_names), None, {200}, True),
+    'api.search_projects': ('GET', lambda ctx: '/api/projects/search/' + random.choice(ctx.tag_names)[:4], None, {200}, True),
+    'api.search_tags': ('GET', lambda ctx: '/api/tags/search/' + random.choice(ctx.tag_names)[:2], None, {200}, True),
+    'api.project_create': ('POST', lambda ctx: '/api/projects', project_body, {200}, True),
+    'api.project_update': ('PUT', lambda ctx: '/api/projects/' + random.choice(ctx.project_ids), project_body, {200}, True),
+    'api.project_batch': ('POST', lambda ctx: '/api/projects/batch', lambda ctx: [project_body(ctx) for _ in range(50)], {200}, True),
+    'api.add_tag': ('POST', lambda ctx: '/api/projects/%s/tags/bench%d' % (random.choice(ctx.project_ids), ctx.unique()), None, {200}, True),
+    'api.remove_tag': ('DELETE', lambda ctx: '/api/projects/%s/tags/%s' % (random.choice(ctx.project_ids), random.choice(ctx.tag_names)), None, {200, 400}, True),
+    'api.like': ('POST', lambda ctx: '/api/projects/%s/reviews' % random.choice(ctx.project_ids), None, {200}, True),
+    'api.unlike': ('DELETE', lambda ctx: '/api/projects/%s/reviews' % random.choice(ctx.project_ids), None, {200, 404}, True),
+    'auth.register': ('POST', lambda ctx: '/auth/register', lambda ctx: {
+        'username': 'bench', 'email': 'bench%d@example.com' % ctx.unique(),
+        'first_name': 'Bench', 'last_name': 'User', 'password': 'password'}, {201}, False),
+    'auth.login': ('POST', lambda ctx: '/auth/login', lambda ctx: {
+        'email': random.choice(ctx.emails), 'password': 'password'}, {200}, False),
+}
+
+
+def seed(projects, clients):
+    """
+    Fill an empty database with users, projects, tags and likes (see `flask seed`).
+    """
+    db.drop_all()
+    db.create_all()
+    dataset = Dataset(max(clients, projects // 10), projects, 100, 5.0, seed=0)
+    dataset.generate(10000)
+    build_feed(50, 1000)
+    user_ids = [dataset.user_id(i) for i in range(dataset.users)]
+    # The load test's own clients may edit any project
+    db.session.execute(db.update(User).where(User.id.in_(user_ids[:clients])).values(admin=True))
+    db.session.commit()
+    return Context(user_ids, [dataset.email(i) for i in range(dataset.users)],
+                   [dataset.project_id(i) for i in range(projects)], dataset.tag_names, {})
+
+
+def run_scenario(name, ctx, clients, requests):
+    method, path, body, ok_codes, authenticated = SCENARIOS[name]
+    latencies = []
+    errors = []
+    queries = [0]
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        queries[0] += 1
+
+    def worker(client_index):
+        client = app.test_client()
+        headers = {}
+        if authenticated:
+            headers['Authorization'] = 'Bearer ' + ctx.tokens[client_index]
+        for _ in range(requests // clients):
+            data = body(ctx) if body else None
+            start = time.perf_counter()
+            response = client.open(path(ctx), method=method, json=data, headers=headers, buffered=True)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code not in ok_codes:
+                errors.append(response.status_code)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(clients) as pool:
+            list(pool.map(worker, range(clients)))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'queries': queries[0] / len(latencies),
+    }
+
+
+def compare(results, baseline, tolerance=None):
+    """
+    :param tolerance: allowed relative p95 growth, or None not to compare latencies
+    :return: list of regression messages
+    """
+    regressions = []
+    for name, result in results.items():
+        if result['errors']:
+            regressions.append('%s: %d unexpected responses' % (name, result['errors']))
+        if name not in baseline:
+            print('Warning: no baseline for %s' % name)
+            continue
+        base = baseline[name]
+        if result['queries'] > base['queries'] + 0.5:
+            regressions.append('%s: %.1f queries per request, baseline %.1f' % (name, result['queries'], base['queries']))
+        if tolerance is not None and result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 %.1f ms, baseline %.1f ms' % (name, result['p95_ms'], base['p95_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--projects', type=int, default=5000, help='projects to seed')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients per endpoint')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--bcrypt-rounds', type=int, default=4, help='BCRYPT_LOG_ROUNDS for the run')
+    parser.add_argument('--check-latency', action='store_true', help='also fail on p95 growth (same machine as the baseline only)')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative p95 growth, with --check-latency')
+    parser.add_argument('--rate-limits', action='store_true', help='keep rate limits on (all clients share one address)')
+    parser.add_argument('--only', nargs='*', help='endpoints to run (default: all)')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    args = parser.parse_args()
+
+    app.config['BCRYPT_LOG_ROUNDS'] = args.bcrypt_rounds
+    # Queue rather than refuse: the load test drives login/register flat out on purpose
+    app.config['BCRYPT_QUEUE_DEPTH'] = max(app.config['BCRYPT_QUEUE_DEPTH'], args.clients)
+    app.config['RATE_LIMIT_ENABLED'] = args.rate_limits
+    names = args.only or list(SCENARIOS)
+    with app.app_context():
+        started = time.perf_counter()
+        ctx = seed(args.projects, args.clients)
+        ctx.tokens = [db.session.get(User, user_id).generate_token() for user_id in ctx.user_ids[:args.clients]]
+        print('Seeded %d projects in %.1fs' % (args.projects, time.perf_counter() - started))
+
+        results = {}
+        print('%-24s %8s %8s %8s %8s %8s %8s %7s' % ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        for name in names:
+            result = results[name] = run_scenario(name, ctx, args.clients, args.requests)
+            print('%-24s %8d %8d %8.1f %8.2f %8.2f %8.2f %7.1f' % (
+                name, result['requests'], result['errors'], result['rps'],
+                result['p50_ms'], result['p95_ms'], result['p99_ms'], result['queries']))
+
+    params = {'projects': args.projects, 'clients': args.clients, 'requests': args.requests}
+    if args.save_baseline:
+        with open(BASELINE, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2, sort_keys=True)
+        print('Saved baseline to ' + BASELINE)
+        return 0
+    baseline = {'params': params, 'results': {}}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+    if baseline['params'] != params:
+        print('Warning: baseline was recorded with %s' % baseline['params'])
+    regressions = compare(results, baseline['results'], args.tolerance if args.check_latency else None)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
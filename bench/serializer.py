@@ -0,0 +1,42 @@
+"""
+Micro-benchmark: reflective ModelEncoder vs. compiled serializers.
+
+Usage: python bench/serializer.py [project count]
+"""
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import app
+from app.models import User, Project, Tag
+from app.util import ModelEncoder, dumps
+
+
+def build_projects(count):
+    tags = [Tag(name='tag%d' % i) for i in range(20)]
+    app.config['BCRYPT_LOG_ROUNDS'] = 4
+    users = [User('user%d' % i, 'user%d@example.com' % i, 'First', 'Last', 'password') for i in range(100)]
+    projects = []
+    for i in range(count):
+        project = Project(id='project-%d' % i, name='Project %d' % i, description='A project ' * 10,
+                          image_url='https://example.com/%d.png' % i, github_url='https://github.com/x/%d' % i,
+                          like_count=i % 50)
+        project.user = users[i % len(users)]
+        project.tags = tags[i % 17:i % 17 + 3]
+        projects.append(project)
+    return projects
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    projects = build_projects(count)
+    assert json.loads(json.dumps(projects, cls=ModelEncoder)) == json.loads(dumps(projects))
+
+    reflective = min(timeit.repeat(lambda: json.dumps(projects, cls=ModelEncoder), number=1, repeat=5))
+    compiled = min(timeit.repeat(lambda: dumps(projects), number=1, repeat=5))
+    print('%d projects' % count)
+    print('ModelEncoder: %8.1f ms' % (reflective * 1000))
+    print('compiled:     %8.1f ms (%.1fx)' % (compiled * 1000, reflective / compiled))
@@ -1,5 +1,7 @@
 import os
 basedir = os.path.abspath(os.path.dirname(__file__))
+replica_urls = [url.strip().replace('postgres://', 'postgresql://')
+                for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
 
 
 class Config(object):
@@ -8,4 +10,84 @@ class Config(object):
                                              'sqlite:///' + os.path.join(basedir, 'app.db')).replace('postgres://', 'postgresql://')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Optional read replicas (comma-separated URLs); read-only API requests are spread over them
+    REPLICA_BINDS = ['replica%d' % i for i in range(len(replica_urls))]
+    SQLALCHEMY_BINDS = dict(zip(REPLICA_BINDS, replica_urls))
+    # How long a user's reads stay on the primary after they write
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+    # Keyset pagination for /api listings
+    API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 50))
+    API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 200))
+
+    # Rows fetched and serialized at a time by streaming exports
+    STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 1000))
+
+    # Tag autocomplete
+    TAG_INDEX_TTL = int(os.environ.get('TAG_INDEX_TTL', 60))
+    TAG_SEARCH_LIMIT = 10
+    # Rebuild interval of the in-memory tag bitmaps behind ?tags= filtering and /api/tags
+    TAG_BITMAP_TTL = int(os.environ.get('TAG_BITMAP_TTL', 60))
+
+    # Rebuild interval of the in-memory related-projects (MinHash) index
+    RELATED_INDEX_TTL = int(os.environ.get('RELATED_INDEX_TTL', 300))
+
+    # Personalized feed: likes considered per user, and how often workers check for a new
+    # similarity matrix from `flask build-feed`
+    FEED_HISTORY = int(os.environ.get('FEED_HISTORY', 100))
+    FEED_RELOAD_INTERVAL = int(os.environ.get('FEED_RELOAD_INTERVAL', 60))
+
+    # Verified auth tokens cached per worker
+    AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+    AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+
+    # Buffered User.last_seen writes
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY', 60))
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL', 10))
+
+    # Password hashing: at most BCRYPT_WORKERS hashes at once over all workers, with
+    # BCRYPT_QUEUE_DEPTH more waiting, beyond which requests get a 503. A waiting request
+    # holds its (sync) gunicorn worker, so the two together should stay below the number of
+    # workers, leaving some for everything else: by default the queue leaves one free of
+    # WEB_CONCURRENCY, which is where gunicorn (and Heroku) take the worker count from.
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', 2))
+    BCRYPT_QUEUE_DEPTH = int(os.environ.get('BCRYPT_QUEUE_DEPTH',
+                                            max(0, int(os.environ.get('WEB_CONCURRENCY', 1)) - BCRYPT_WORKERS - 1)))
+    BCRYPT_RETRY_AFTER = 1
+
+    # SQLite file for state shared by all workers (see app/store.py); unset, each process
+    # keeps its own in memory. gunicorn.conf.py sets it.
+    SHARED_STORE = os.environ.get('SHARED_STORE')
+
+    # Rate limits: token buckets of (requests, seconds) by endpoint, per client IP and, where
+    # listed, per account email. 'api.write' covers every /api write route not listed itself.
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+    RATE_LIMITS = {
+        'auth.login': {'ip': (30, 60), 'email': (10, 60)},
+        'auth.register': {'ip': (10, 3600), 'email': (3, 3600)},
+        'auth.reset_password': {'ip': (10, 3600)},
+        'api.api_project_batch': {'ip': (20, 60)},
+        'api.write': {'ip': (300, 60)},
+    }
+    # Proxies in front of the app appending to X-Forwarded-For. Heroku (which sets DYNO)
+    # has its router; counting none there would put every client in the router's buckets.
+    RATE_LIMIT_PROXIES = int(os.environ.get('RATE_LIMIT_PROXIES', 1 if 'DYNO' in os.environ else 0))
+
+    # Projects per transaction in /api/projects/batch
+    BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 500))
+
+    # Trending projects: a like's weight halves every TRENDING_HALF_LIFE seconds.
+    # Weights grow as 2 ** ((t - TRENDING_EPOCH) / TRENDING_HALF_LIFE), so move the epoch
+    # forward (and run `flask recompute-trending`) every few years to stay within float range.
+    TRENDING_EPOCH = 1672531200  # 2023-01-01
+    TRENDING_HALF_LIFE = int(os.environ.get('TRENDING_HALF_LIFE', 7 * 24 * 60 * 60))
+    TRENDING_CACHE_TTL = int(os.environ.get('TRENDING_CACHE_TTL', 30))
+
+    # If set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # Per-request SQL/auth/serialization timings in a Server-Timing header and the logs
+    REQUEST_TIMING = os.environ.get('REQUEST_TIMING', '0') == '1'
+
     WEB_DOMAIN = 'https://devfly.herokuapp.com'
@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+# Workers write their Prometheus samples here so that /metrics can add them up (see app/metrics.py).
+# A fresh directory per master, so counters from a previous run are never picked up.
+if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='prometheus-')
+
+# State shared by all workers: rate limits, bcrypt slots... (see app/store.py)
+if 'SHARED_STORE' not in os.environ:
+    os.environ['SHARED_STORE'] = os.path.join(tempfile.mkdtemp(prefix='shared-'), 'store.sqlite')
+
+
+def post_fork(server, worker):
+    # Have the feed's similarity matrix in memory before the first request
+    from app.feed import feed_model
+    feed_model.warm()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,32 @@
+"""add project similarity
+
+Revision ID: 1a6d3e9f4c27
+Revises: f7b2c5e8a913
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a6d3e9f4c27'
+down_revision = 'f7b2c5e8a913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled in by `flask build-feed`
+    op.create_table('project_similarity',
+    sa.Column('project_id', sa.String(), nullable=False),
+    sa.Column('similar_id', sa.String(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['project.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['similar_id'], ['project.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('project_id', 'similar_id')
+    )
+
+
+def downgrade():
+    op.drop_table('project_similarity')
@@ -0,0 +1,86 @@
+"""add project search index
+
+Revision ID: 3f1c9a7b5e42
+Revises: 6c5ddb39e569
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a7b5e42'
+down_revision = '6c5ddb39e569'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("""
+            CREATE TABLE project_search (
+                project_id VARCHAR PRIMARY KEY REFERENCES project (id) ON DELETE CASCADE,
+                document TSVECTOR NOT NULL
+            )
+        """)
+        op.execute('CREATE INDEX ix_project_search_document ON project_search USING GIN (document)')
+        op.execute("""
+            INSERT INTO project_search (project_id, document)
+            SELECT project.id,
+                   setweight(to_tsvector('english', coalesce(project.name, '')), 'A')
+                   || setweight(to_tsvector('english', coalesce(project.description, '')), 'B')
+                   || setweight(to_tsvector('english', coalesce(string_agg(tagging.tag_name, ' '), '')), 'C')
+            FROM project LEFT JOIN tagging ON tagging.project_id = project.id
+            GROUP BY project.id
+        """)
+    elif dialect == 'sqlite':
+        op.execute("""
+            CREATE TABLE project_search (
+                id INTEGER PRIMARY KEY,
+                project_id VARCHAR NOT NULL UNIQUE,
+                name VARCHAR,
+                description VARCHAR,
+                tags VARCHAR
+            )
+        """)
+        op.execute("""
+            CREATE VIRTUAL TABLE project_fts USING fts5(
+                name, description, tags, content='project_search', content_rowid='id'
+            )
+        """)
+        op.execute("""
+            CREATE TRIGGER project_search_ai AFTER INSERT ON project_search BEGIN
+                INSERT INTO project_fts (rowid, name, description, tags)
+                VALUES (new.id, new.name, new.description, new.tags);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER project_search_ad AFTER DELETE ON project_search BEGIN
+                INSERT INTO project_fts (project_fts, rowid, name, description, tags)
+                VALUES ('delete', old.id, old.name, old.description, old.tags);
+            END
+        """)
+        op.execute("""
+            CREATE TRIGGER project_search_au AFTER UPDATE ON project_search BEGIN
+                INSERT INTO project_fts (project_fts, rowid, name, description, tags)
+                VALUES ('delete', old.id, old.name, old.description, old.tags);
+                INSERT INTO project_fts (rowid, name, description, tags)
+                VALUES (new.id, new.name, new.description, new.tags);
+            END
+        """)
+        op.execute("""
+            INSERT INTO project_search (project_id, name, description, tags)
+            SELECT project.id, project.name, project.description, group_concat(tagging.tag_name, ' ')
+            FROM project LEFT JOIN tagging ON tagging.project_id = project.id
+            GROUP BY project.id
+        """)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS project_fts')
+    if dialect in ('postgresql', 'sqlite'):
+        op.execute('DROP TABLE IF EXISTS project_search')
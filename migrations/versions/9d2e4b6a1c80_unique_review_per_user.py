@@ -0,0 +1,35 @@
+"""unique review per user and project
+
+Revision ID: 9d2e4b6a1c80
+Revises: 3f1c9a7b5e42
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2e4b6a1c80'
+down_revision = '3f1c9a7b5e42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Drop duplicate likes, keeping the earliest, then repair the counts they inflated
+    op.execute("""
+        DELETE FROM review WHERE id NOT IN (
+            SELECT min(id) FROM review GROUP BY user_id, project_id
+        )
+    """)
+    op.execute("""
+        UPDATE project SET like_count = (
+            SELECT count(*) FROM review WHERE review.project_id = project.id
+        )
+    """)
+    op.create_index('uq_review_user_id_project_id', 'review', ['user_id', 'project_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_review_user_id_project_id', table_name='review')
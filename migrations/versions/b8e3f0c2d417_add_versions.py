@@ -0,0 +1,40 @@
+"""add versions for etags
+
+Revision ID: b8e3f0c2d417
+Revises: 9d2e4b6a1c80
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e3f0c2d417'
+down_revision = '9d2e4b6a1c80'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('project', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    collection_version = op.create_table('collection_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=32), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_collection_version_name_id', 'collection_version', ['name', 'id'])
+    op.bulk_insert(collection_version, [
+        {'name': 'projects'},
+        {'name': 'users'},
+    ])
+
+
+def downgrade():
+    op.drop_index('ix_collection_version_name_id', table_name='collection_version')
+    op.drop_table('collection_version')
+    with op.batch_alter_table('project') as batch_op:
+        batch_op.drop_column('version')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('version')
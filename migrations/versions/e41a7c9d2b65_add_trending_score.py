@@ -0,0 +1,28 @@
+"""add trending score
+
+Revision ID: e41a7c9d2b65
+Revises: b8e3f0c2d417
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41a7c9d2b65'
+down_revision = 'b8e3f0c2d417'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Scores start at zero; fill them in with `flask recompute-trending`
+    op.add_column('project', sa.Column('trending_score', sa.Float(), server_default='0', nullable=False))
+    op.create_index(op.f('ix_project_trending_score'), 'project', ['trending_score'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_project_trending_score'), table_name='project')
+    with op.batch_alter_table('project') as batch_op:
+        batch_op.drop_column('trending_score')
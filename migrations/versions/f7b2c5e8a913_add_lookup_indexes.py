@@ -0,0 +1,120 @@
+"""add indexes for hot lookups
+
+Revision ID: f7b2c5e8a913
+Revises: e41a7c9d2b65
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7b2c5e8a913'
+down_revision = 'e41a7c9d2b65'
+branch_labels = None
+depends_on = None
+
+
+# (name, table, columns, unique)
+INDEXES = (
+    ('ix_user_email', 'user', ['email'], True),
+    ('ix_user_registered_at_id', 'user', ['registered_at', 'id'], False),
+    ('ix_project_created_at_id', 'project', ['created_at', 'id'], False),
+    ('ix_project_user_id_created_at_id', 'project', ['user_id', 'created_at', 'id'], False),
+    ('ix_review_project_id', 'review', ['project_id'], False),
+    ('uq_tagging_project_id_tag_name', 'tagging', ['project_id', 'tag_name'], True),
+    ('ix_tagging_tag_name', 'tagging', ['tag_name'], False),
+)
+
+# (table, column) of the keys listings are paged by, along with id
+LISTING_KEYS = (
+    ('user', 'registered_at'),
+    ('project', 'created_at'),
+)
+
+
+def require_listing_keys():
+    """
+    Give rows without a listing key 0, where tag filters already listed them, and make the
+    columns NOT NULL: keyset pagination can't step past a NULL key.
+    """
+    for table, column in LISTING_KEYS:
+        op.execute('UPDATE "{table}" SET {column} = 0 WHERE {column} IS NULL'.format(table=table, column=column))
+    if op.get_bind().dialect.name != 'postgresql':
+        for table, column in LISTING_KEYS:
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.alter_column(column, existing_type=sa.Integer(), nullable=False)
+        return
+    # SET NOT NULL scans the table while holding off all reads and writes, unless a
+    # validated check constraint already proves it; validating holds off neither
+    with op.get_context().autocommit_block():
+        for table, column in LISTING_KEYS:
+            check = 'ck_{table}_{column}_not_null'.format(table=table, column=column)
+            op.execute('ALTER TABLE "{table}" DROP CONSTRAINT IF EXISTS {check}'.format(table=table, check=check))
+            op.execute('ALTER TABLE "{table}" ADD CONSTRAINT {check} CHECK ({column} IS NOT NULL) NOT VALID'
+                       .format(table=table, check=check, column=column))
+            op.execute('ALTER TABLE "{table}" VALIDATE CONSTRAINT {check}'.format(table=table, check=check))
+            op.alter_column(table, column, existing_type=sa.Integer(), nullable=False)
+            op.execute('ALTER TABLE "{table}" DROP CONSTRAINT {check}'.format(table=table, check=check))
+
+
+def normalize_emails():
+    """
+    Store emails as the app looks them up (lowercased, trimmed), so the unique index holds.
+    :raise RuntimeError: if two accounts share an email that way, which someone has to resolve
+    """
+    bind = op.get_bind()
+    clashes = bind.execute(sa.text("""
+        SELECT lower(trim(email)) FROM "user" WHERE email IS NOT NULL
+        GROUP BY lower(trim(email)) HAVING count(*) > 1
+    """)).scalars().all()
+    if clashes:
+        raise RuntimeError('Several users share each of these emails, merge or remove them first: %s'
+                           % ', '.join(sorted(clashes)))
+    op.execute('UPDATE "user" SET email = lower(trim(email)) WHERE email <> lower(trim(email))')
+
+
+def drop_invalid_indexes():
+    # A CREATE INDEX CONCURRENTLY that failed (say on a duplicate) leaves an INVALID index
+    # behind, which if_not_exists would take for done
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    invalid = bind.execute(sa.text("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE NOT i.indisvalid AND c.relname IN :names
+    """).bindparams(sa.bindparam('names', expanding=True)),
+        {'names': [name for name, table, columns, unique in INDEXES]}).scalars().all()
+    for name in invalid:
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS "%s"' % name)
+
+
+def upgrade():
+    require_listing_keys()
+    normalize_emails()
+    # The same tag could be attached to a project twice; keep one row of each pair
+    dialect = op.get_bind().dialect.name
+    row_id = {'postgresql': 'ctid', 'sqlite': 'rowid'}.get(dialect)
+    if row_id:
+        op.execute("""
+            DELETE FROM tagging WHERE {row_id} NOT IN (
+                SELECT min({row_id}) FROM tagging GROUP BY project_id, tag_name
+            )
+        """.format(row_id=row_id))
+    # Build indexes without locking writes out of the tables on Postgres. CONCURRENTLY
+    # can't run in a transaction, hence the autocommit block. Safe to rerun after a failure.
+    with op.get_context().autocommit_block():
+        drop_invalid_indexes()
+        for name, table, columns, unique in INDEXES:
+            op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True,
+                            if_not_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    for table, column in LISTING_KEYS:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, existing_type=sa.Integer(), nullable=True)